@@ -1,6 +1,8 @@
 from enum import Enum, auto
-from operator import add, sub
-from typing import Callable, Generator, Iterable
+from typing import Optional
+
+from ai import Searcher
+from bitboard import Bitboard
 
 
 def clear_screen():
@@ -21,34 +23,43 @@ class Cell(Enum):
                 return "🟡"
 
 class Grid:
-    __slots__ = ("rows", "columns", "current_player", "inner")
+    __slots__ = ("rows", "columns", "current_player", "board", "_inner")
 
     rows: int
     columns: int
     current_player: Cell
 
-    # row = inner[i]
-    # cell = inner[i][i]
-    inner: list[list[Cell]]
+    board: Bitboard
+    # Cache of `inner`, cleared whenever a piece is added
+    _inner: list[list[Cell]] | None
 
     def __init__(self, columns: int = 7, rows: int = 6) -> None:
         self.rows = rows
         self.columns = columns
         self.current_player = Cell.RED_PLAYER
-        self.inner = [[Cell.EMPTY for _ in range(columns)] for _ in range(rows)]
+        self.board = Bitboard(columns, rows)
+        self._inner = None
 
-    def __str__(self) -> str:
-        # Start off with a line of indexes
-        out = " " + "  ".join(map(str, range(1, self.columns + 1))) + "\n"
+    @property
+    def inner(self) -> list[list[Cell]]:
+        """The board as a 2D list, built from `self.board` on first access
 
-        # Loop through each column and row, concatenating each cell
-        for column in self.inner:
-            for cell in column:
-                out += f"{cell} "
+        row = inner[i]
+        cell = inner[i][i]
+        """
+        if self._inner is None:
+            self._inner = self.board.to_rows((Cell.EMPTY, Cell.RED_PLAYER, Cell.YELLOW_PLAYER))
 
-            out += "\n"
+        return self._inner
 
-        return out
+    def __str__(self) -> str:
+        # Start off with a line of indexes
+        header = " " + "  ".join(map(str, range(1, self.columns + 1)))
+
+        # Each row is joined from its cells, then every line is joined at once,
+        # instead of growing one string a cell at a time
+        rows = ("".join(f"{cell} " for cell in row) for row in self.inner)
+        return "\n".join((header, *rows)) + "\n"
 
 
     def swap_current_player(self):
@@ -60,120 +71,105 @@ class Grid:
             case Cell.YELLOW_PLAYER:
                 self.current_player = Cell.RED_PLAYER
 
-    def check_neighbours(self, iterable: Iterable[Cell]):
-        """Checks for 4 consecutive Cells of self.current_player
-
-        Args:
-            iterable: The iterable to find consecutive cells in.
-        """
-
-        same_count = 0
-        for cell in iterable:
-            if cell != Cell.EMPTY and cell == self.current_player:
-                same_count += 1
-                if same_count == 4:
-                    return True
-            else:
-                same_count = 0
-
-        return False
-
-    def diagnoal_iter(self, x: int, y: int, y_op: Callable[[int, int], int]) -> Generator[Cell, None, None]:
-        """A generator to loop over `self.inner` diagonally
-
-        This is performed by taking `x` and `y` from the current position on the board
-        and allows me to continue using check_neighbours for the actual checking of
-        "are there 4 matching cells".
-
-        Args:
-            x: The x position of the starting Cell.
-            y: The y position of the starting Cell.
-            y_op: The operation to perform on `y`, either `add` or `sub` for up right or down right matches.
-        """
-
-        i = 0
-        while True:
-            try:
-                yield self.inner[y_op(y, i)][x + i]
-            except IndexError:
-                # Went off the board, no more Cells
-                return
-
-            i += 1
-
+    def player_index(self) -> int:
+        """Gets the index of `self.current_player` in `self.board`"""
+        assert self.current_player != Cell.EMPTY
+        return 0 if self.current_player == Cell.RED_PLAYER else 1
 
-    def add_piece(self, column_idx: int) -> bool:
+    def add_piece(self, column_idx: int) -> Optional[int]:
         """Adds a piece to the Grid
 
         Args:
             column_idx: The index of the column to add the piece to.
-            kind: The type of Cell to add, must not be EMPTY
 
         Returns:
-            If piece addition was successful
+            The index of the row in `inner` the piece landed on, or None if the column was full
         """
-        assert self.current_player != Cell.EMPTY
+        row = self.board.drop(column_idx, self.player_index())
+        if row is None:
+            return None
 
-        for row_idx in range(self.rows - 1, -1, -1):
-            if self.inner[row_idx][column_idx] == Cell.EMPTY:
-                self.inner[row_idx][column_idx] = self.current_player
-                return True
+        self._inner = None
+        return self.rows - 1 - row
 
-        return False
+    def check_win_condition(self, last_move: Optional[tuple[int, int]] = None) -> bool:
+        """Checks if `self.current_player` has won
 
-    def check_win_condition(self) -> bool:
-        assert self.current_player != Cell.EMPTY
+        Args:
+            last_move: The row and column returned from the last `add_piece`, if given
+                only the lines through this cell are checked instead of the whole board.
+        """
+        if last_move is None:
+            return self.board.has_won(self.player_index())
 
-        # Check horizontal
-        if any(map(self.check_neighbours, self.inner)):
-            return True
+        row, column = last_move
+        return self.board.has_won_at(self.rows - 1 - row, column, self.player_index())
 
-        # Check vertical
-        for column_idx in range(0, self.columns):
-            if self.check_neighbours((row[column_idx] for row in self.inner)):
-                return True
+    def key(self) -> int:
+        """A 64 bit Zobrist hash of the position, updated with every piece added"""
+        return self.board.zobrist
 
-        # Check diagonal
-        for (y, row) in enumerate(self.inner):
-            for (x, cell) in enumerate(row):
-                if cell == Cell.EMPTY:
-                    continue
+    def is_column_full(self, column_idx: int) -> bool:
+        return self.board.is_full(column_idx)
 
-                if self.check_neighbours(self.diagnoal_iter(x, y, add)):
-                    return True
+    def is_draw(self) -> bool:
+        """Checks if the board is full, this should only be checked after `check_win_condition`"""
+        return self.board.is_draw()
 
-                if self.check_neighbours(self.diagnoal_iter(x, y, sub)):
-                    return True
+    def play(self, bot: Optional[Cell] = None):
+        """Plays a game in the terminal until someone wins or the board is full
 
-        return False
+        Args:
+            bot: The player to be controlled by the computer, or None for a two player game.
+        """
+        searcher = Searcher()
+        last_search = None
 
-    def play(self):
         while True:
             clear_screen()
             print(self)
-            
-            index = input(f"{self.current_player} Column to drop piece on: ")
+            if last_search is not None:
+                print(f"Computer searched {last_search}")
+
+            if self.current_player == bot:
+                last_search = searcher.best_move(self.board, self.player_index())
+                index = last_search.column
+            else:
+                index = input(f"{self.current_player} Column to drop piece on: ")
 
-            try:
-                index = int(index) - 1
-            except ValueError:
-                continue # User did not type a valid number
+                try:
+                    index = int(index) - 1
+                except ValueError:
+                    continue # User did not type a valid number
 
-            if 0 < index > self.columns:
+            if not 0 <= index < self.columns:
                 continue # User selected index off the board
 
-            if not self.add_piece(index):
+            if self.is_column_full(index):
                 continue # No space on the board
 
-            if self.check_win_condition():
+            row = self.add_piece(index)
+
+            if self.check_win_condition((row, index)):
                 # Do one more refresh to show winning play
                 clear_screen()
-                print(f"{self}\n{self.current_player} You won!")
+                if self.current_player == bot:
+                    print(f"{self}\n{self.current_player} The computer won!")
+                else:
+                    print(f"{self}\n{self.current_player} You won!")
+                return
+
+            if self.is_draw():
+                clear_screen()
+                print(f"{self}\nThe board is full, it's a draw!")
                 return
 
             self.swap_current_player()
 
 try:
-    Grid().play()
+    if input("Play against the computer? (y/N): ").lower() == "y":
+        Grid().play(bot=Cell.YELLOW_PLAYER)
+    else:
+        Grid().play()
 except KeyboardInterrupt:
     print()
@@ -0,0 +1,292 @@
+import time
+from typing import NamedTuple, Optional
+
+from bitboard import Bitboard
+
+# Scores above this are forced wins, the exact score counts down with the
+# number of moves played so a quicker win is always preferred.
+WIN_SCORE = 1_000_000
+
+# Transposition table entry flags, for if the stored score is exact or just a bound
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+
+
+class SearchTimeout(Exception):
+    """Raised inside the search when the time budget for a move runs out"""
+
+
+class SearchResult(NamedTuple):
+    column: int
+    score: int
+    # The deepest search that fully finished
+    depth: int
+    nodes: int
+    seconds: float
+
+    @property
+    def nodes_per_second(self) -> float:
+        return self.nodes / self.seconds if self.seconds else float(self.nodes)
+
+    def __str__(self) -> str:
+        return (
+            f"depth {self.depth}, {self.nodes} nodes in {self.seconds:.2f}s "
+            f"({self.nodes_per_second:,.0f} nodes/s)"
+        )
+
+
+class Searcher:
+    """A Connect 4 AI using negamax search with alpha-beta pruning
+
+    The search works on the raw integers of a `Bitboard`, with `position` being the
+    mask of the player to move and `mask` being every piece on the board. Swapping
+    to the other player is then just `position ^ mask`, so no undo is needed.
+    """
+
+    __slots__ = (
+        "time_budget", "table_size", "keys", "entries", "nodes", "deadline",
+        "rows", "columns", "height", "bottom_mask", "board_mask", "column_masks", "move_order",
+    )
+
+    time_budget: float
+
+    # The transposition table, a fixed size array indexed by `key % table_size`
+    # with the full key stored alongside to detect collisions.
+    table_size: int
+    keys: list[int]
+    entries: list[Optional[tuple[int, int, int, int]]]
+
+    nodes: int
+    deadline: float
+
+    rows: int
+    columns: int
+    height: int
+    bottom_mask: int
+    board_mask: int
+    column_masks: list[int]
+    # Columns ordered from the center out, as center moves are part of more lines
+    move_order: list[int]
+
+    def __init__(self, time_budget: float = 1.0, table_size: int = 1 << 18) -> None:
+        """
+        Args:
+            time_budget: The number of seconds to spend searching each move.
+            table_size: The maximum number of positions to store in the transposition table.
+        """
+        self.time_budget = time_budget
+        self.table_size = table_size
+        self.keys = [0] * table_size
+        self.entries = [None] * table_size
+        self.nodes = 0
+        self.deadline = 0.0
+
+        self.rows = self.columns = self.height = 0
+
+    def setup(self, board: Bitboard) -> None:
+        """Precomputes the masks for the board size, clearing the table if the size changed
+
+        Raises:
+            ValueError: If the board is not played to 4 in a row, the only rule `winning_cells` knows
+        """
+        if board.connect != 4:
+            raise ValueError(f"The AI can only play 4 in a row, not {board.connect}")
+        if (board.rows, board.columns) == (self.rows, self.columns):
+            return
+
+        self.rows = board.rows
+        self.columns = board.columns
+        self.height = board.height
+
+        self.column_masks = [board.bit(0, c) * ((1 << board.rows) - 1) for c in range(board.columns)]
+        self.bottom_mask = sum(board.bit(0, c) for c in range(board.columns))
+        self.board_mask = sum(self.column_masks)
+
+        center = (board.columns - 1) / 2
+        self.move_order = sorted(range(board.columns), key=lambda c: abs(c - center))
+
+        self.keys = [0] * self.table_size
+        self.entries = [None] * self.table_size
+
+    def key(self, position: int, mask: int) -> int:
+        """A compact hash of the board, the same as `Bitboard.key`"""
+        return position + mask
+
+    def winning_cells(self, position: int, mask: int) -> int:
+        """Gets a mask of the empty cells that would complete 4 in a row for `position`"""
+        # Vertical, only possible with 3 pieces directly below
+        cells = (position << 1) & (position << 2) & (position << 3)
+
+        for shift in (self.height, self.height + 1, self.height - 1):
+            # XXX_ and XX_X
+            pair = (position << shift) & (position << 2 * shift)
+            cells |= pair & (position << 3 * shift)
+            cells |= pair & (position >> shift)
+
+            # _XXX and X_XX
+            pair = (position >> shift) & (position >> 2 * shift)
+            cells |= pair & (position << shift)
+            cells |= pair & (position >> 3 * shift)
+
+        return cells & (self.board_mask ^ mask)
+
+    def evaluate(self, position: int, mask: int) -> int:
+        """Scores a position without searching, by the number of cells each player threatens"""
+        own = self.winning_cells(position, mask).bit_count()
+        opponent = self.winning_cells(position ^ mask, mask).bit_count()
+        return own - opponent
+
+    def negamax(self, position: int, mask: int, moves: int, depth: int, alpha: int, beta: int) -> int:
+        """Scores a position for the player to move
+
+        Args:
+            position: The pieces of the player to move.
+            mask: Every piece on the board.
+            moves: The number of pieces on the board.
+            depth: The number of moves left to search before evaluating.
+            alpha: The score the player to move is already guaranteed.
+            beta: The score the opponent is already guaranteed.
+        """
+        self.nodes += 1
+        if self.nodes & 0xFFF == 0 and time.perf_counter() > self.deadline:
+            raise SearchTimeout
+
+        possible = (mask + self.bottom_mask) & self.board_mask
+        if self.winning_cells(position, mask) & possible:
+            return WIN_SCORE - moves - 1
+
+        if moves + 1 >= self.rows * self.columns:
+            # Only a drawing move is left, or the board is full
+            return 0
+
+        opponent_wins = self.winning_cells(position ^ mask, mask)
+        forced = possible & opponent_wins
+        if forced:
+            if forced & (forced - 1):
+                # Two threats at once, only one can be blocked
+                return -(WIN_SCORE - moves - 2)
+
+            possible = forced
+
+        # Playing directly under an opponent's winning cell gives it to them
+        possible &= ~(opponent_wins >> 1)
+        if not possible:
+            return -(WIN_SCORE - moves - 2)
+
+        if depth == 0:
+            return self.evaluate(position, mask)
+
+        original_alpha = alpha
+        key = self.key(position, mask)
+        index = key % self.table_size
+        best_column = -1
+
+        if self.keys[index] == key and (entry := self.entries[index]) is not None:
+            entry_depth, flag, value, best_column = entry
+            if entry_depth >= depth:
+                if flag == EXACT:
+                    return value
+                elif flag == LOWER_BOUND:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+
+                if alpha >= beta:
+                    return value
+
+        order = self.move_order
+        if best_column != -1:
+            # Try the best move from an earlier search first
+            order = [best_column, *(c for c in order if c != best_column)]
+
+        best_score = -WIN_SCORE
+        for column in order:
+            move = possible & self.column_masks[column]
+            if not move:
+                continue
+
+            score = -self.negamax(position ^ mask, mask | move, moves + 1, depth - 1, -beta, -alpha)
+            if score > best_score:
+                best_score = score
+                best_column = column
+
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+
+        if best_score <= original_alpha:
+            flag = UPPER_BOUND
+        elif best_score >= beta:
+            flag = LOWER_BOUND
+        else:
+            flag = EXACT
+
+        self.keys[index] = key
+        self.entries[index] = (depth, flag, best_score, best_column)
+        return best_score
+
+    def search_root(self, position: int, mask: int, moves: int, depth: int) -> tuple[int, int]:
+        """Searches every move from the root to `depth`, returning the best column and its score"""
+        best_column = -1
+        alpha = -WIN_SCORE
+        beta = WIN_SCORE
+
+        for column in self.move_order:
+            if mask & self.column_masks[column] == self.column_masks[column]:
+                continue
+
+            move = (mask + self.bottom_mask) & self.column_masks[column]
+            if self.winning_cells(position, mask) & move:
+                return column, WIN_SCORE - moves - 1
+
+            score = -self.negamax(position ^ mask, mask | move, moves + 1, depth - 1, -beta, -alpha)
+            if best_column == -1 or score > alpha:
+                best_column = column
+                alpha = score
+
+        return best_column, alpha
+
+    def best_move(self, board: Bitboard, player: int) -> SearchResult:
+        """Finds the best column for `player` to play in, using iterative deepening
+
+        Each iteration searches one move deeper than the last, until the time budget
+        is used up or the result of the game is known. The move from the deepest
+        completed iteration is then used.
+
+        Args:
+            board: The board to search, this is not modified.
+            player: The index of the player to find a move for.
+
+        Raises:
+            ValueError: If the board is full, or is not played to 4 in a row.
+        """
+        self.setup(board)
+        self.nodes = 0
+
+        start = time.perf_counter()
+        self.deadline = start + self.time_budget
+
+        position = board.masks[player]
+        mask = board.occupied
+        moves = board.moves
+        empty = board.rows * board.columns - moves
+
+        # Fall back to the first free column, in case not even depth 1 finishes
+        column = next((c for c in self.move_order if not board.is_full(c)), None)
+        if column is None:
+            raise ValueError("The board is full, so there is no move to make")
+        score = 0
+        completed = 0
+
+        for depth in range(1, empty + 1):
+            try:
+                column, score = self.search_root(position, mask, moves, depth)
+            except SearchTimeout:
+                break
+
+            completed = depth
+            if abs(score) > WIN_SCORE // 2:
+                break
+
+        return SearchResult(column, score, completed, self.nodes, time.perf_counter() - start)
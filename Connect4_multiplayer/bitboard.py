@@ -0,0 +1,205 @@
+import random
+from typing import Optional, Sequence, TypeVar
+
+T = TypeVar("T")
+
+# Random 64 bit numbers for each player and bit index, generated from a fixed seed
+# so every process gets the same hashes for the same position.
+ZOBRIST_SEED = 0xC4
+zobrist_random = random.Random(ZOBRIST_SEED)
+zobrist_table: list[tuple[int, int]] = []
+
+def zobrist_value(index: int, player: int) -> int:
+    """Gets the random number for `player` owning the bit at `index`, growing the table if needed"""
+    while len(zobrist_table) <= index:
+        zobrist_table.append((zobrist_random.getrandbits(64), zobrist_random.getrandbits(64)))
+
+    return zobrist_table[index][player]
+
+
+class Bitboard:
+    """A Connect 4 board stored as integer bitmasks
+
+    Each column takes up `rows + 1` bits, starting from the bottom row, with the
+    extra bit at the top of each column always left empty. That spare bit means
+    shifting a mask sideways or diagonally can never wrap a line of pieces from
+    the top of one column onto the bottom of the next.
+
+    Players are referred to by index, 0 for the first player and 1 for the second.
+    """
+
+    __slots__ = ("rows", "columns", "connect", "height", "masks", "occupied", "heights", "moves", "zobrist")
+
+    rows: int
+    columns: int
+    # The number of pieces in a row needed to win
+    connect: int
+    # Bits per column, including the empty sentinel bit
+    height: int
+
+    # One mask per player, with a set bit for every piece they own
+    masks: list[int]
+    # Every piece on the board, the OR of both player masks
+    occupied: int
+
+    # The number of pieces in each column, which is also the row the next piece lands on
+    heights: list[int]
+    # The number of pieces on the whole board
+    moves: int
+
+    # A 64 bit hash of the position, XORed with a random number for every piece added
+    zobrist: int
+
+    def __init__(self, columns: int, rows: int, connect: int = 4) -> None:
+        self.rows = rows
+        self.columns = columns
+        self.connect = connect
+        self.height = rows + 1
+        self.masks = [0, 0]
+        self.occupied = 0
+        self.heights = [0] * columns
+        self.moves = 0
+        self.zobrist = 0
+
+    def bit(self, row: int, column: int) -> int:
+        """Gets the bit for a position on the board
+
+        Args:
+            row: The row of the cell, where 0 is the bottom of the board.
+            column: The column of the cell.
+        """
+        return 1 << (column * self.height + row)
+
+    def key(self, player: int) -> int:
+        """A compact key for the board with `player` to move, unique for every position
+
+        Adding `occupied` sets the bit above each column's top piece, which encodes
+        the height of each column alongside which pieces belong to `player`.
+        """
+        return self.masks[player] + self.occupied
+
+    def is_full(self, column: int) -> bool:
+        """Checks if a column has no space left for another piece"""
+        return self.heights[column] == self.rows
+
+    def is_draw(self) -> bool:
+        """Checks if every column is full, so no more pieces can be played"""
+        return self.moves == self.rows * self.columns
+
+    def directions(self) -> tuple[int, int, int, int]:
+        """The shifts to move one cell vertically, horizontally, and along both diagonals"""
+        return (1, self.height, self.height + 1, self.height - 1)
+
+    def drop(self, column: int, player: int) -> Optional[int]:
+        """Drops a piece for `player` into a column
+
+        Args:
+            column: The index of the column to drop the piece into.
+            player: The index of the player the piece belongs to.
+
+        Returns:
+            The row the piece landed on, where 0 is the bottom, or None if the column is full
+        """
+        row = self.heights[column]
+        if row == self.rows:
+            return None
+
+        move = self.bit(row, column)
+        self.masks[player] |= move
+        self.occupied |= move
+        self.heights[column] = row + 1
+        self.moves += 1
+        self.zobrist ^= zobrist_value(column * self.height + row, player)
+        return row
+
+    def has_won(self, player: int) -> bool:
+        """Checks if `player` has `connect` pieces in a row anywhere on the board
+
+        For each direction, ANDing the mask with itself shifted by one step
+        leaves only the start of each run of 2, then doing the same with a
+        shift of two steps leaves only the start of each run of 4. The run
+        length doubles each time, until the last shift tops it up to exactly
+        `connect`, so this only takes a handful of shifts even for long runs.
+        """
+        mask = self.masks[player]
+
+        for shift in self.directions():
+            runs = mask
+            length = 1
+            while runs and length < self.connect:
+                step = min(length, self.connect - length)
+                runs &= runs >> (step * shift)
+                length += step
+
+            if runs:
+                return True
+
+        return False
+
+    def has_won_at(self, row: int, column: int, player: int) -> bool:
+        """Checks if the piece at a position is part of `connect` in a row for `player`
+
+        Only the 4 lines through that cell are walked, so this is all that is
+        needed after each move, as a new line can only be made by the last piece.
+
+        Args:
+            row: The row of the cell, where 0 is the bottom of the board.
+            column: The column of the cell.
+            player: The index of the player to check for.
+        """
+        index = column * self.height + row
+        reach = self.connect - 1
+
+        for shift in self.directions():
+            # Only cells less than `connect` steps away can be in a line with this one,
+            # so cut those out of the mask first. On a big board this keeps the walk
+            # to small integers, instead of shifting the whole board every step.
+            start = max(0, index - reach * shift)
+            window = (self.masks[player] >> start) & ((1 << (index - start + reach * shift + 1)) - 1)
+            bit = 1 << (index - start)
+            count = 1
+
+            # Walk away from the cell in both directions until a gap is found,
+            # the empty sentinel bits stop the walk at the edge of the board
+            next_bit = bit << shift
+            while count < self.connect and window & next_bit:
+                count += 1
+                next_bit <<= shift
+
+            next_bit = bit >> shift
+            while count < self.connect and window & next_bit:
+                count += 1
+                next_bit >>= shift
+
+            if count == self.connect:
+                return True
+
+        return False
+
+    def to_rows(self, cells: Sequence[T]) -> list[list[T]]:
+        """Builds a 2D list of the board, with the top row first
+
+        Args:
+            cells: The values to use for an empty cell, the first player and the second player.
+        """
+        empty, first, second = cells
+
+        # Each mask as a string of bits, lowest first, so each cell is an index
+        # instead of testing a bit of the whole mask
+        size = self.columns * self.height
+        first_bits, second_bits = (format(mask, f"0{size}b")[::-1] for mask in self.masks)
+
+        out = []
+        for row in range(self.rows - 1, -1, -1):
+            out_row = []
+            for index in range(row, size, self.height):
+                if first_bits[index] == "1":
+                    out_row.append(first)
+                elif second_bits[index] == "1":
+                    out_row.append(second)
+                else:
+                    out_row.append(empty)
+
+            out.append(out_row)
+
+        return out
@@ -1,166 +1,528 @@
 import asyncio
 import json
-from typing import Awaitable
+import shutil
+import sys
+from typing import Awaitable, Callable, Optional, Union
+from urllib.parse import urlsplit, urlunsplit
 
-from websockets.client import WebSocketClientProtocol, connect
+import pydantic
+from websockets.client import connect
+from websockets.exceptions import ConnectionClosed
 
+from keyboard import Keyboard
 from shared import *
 
 
-def ainput(question: str) -> Awaitable[str]:
-    return asyncio.to_thread(input, question)
+# The number of times to try reconnecting to a game before giving up, a second apart
+RECONNECT_ATTEMPTS = 25
+# Each cell is drawn as an emoji and a space, taking up this many columns of the terminal
+CELL_WIDTH = 3
+# The line of the terminal the top row of the board is drawn on, under the title and the column numbers
+BOARD_TOP = 3
+
+def redirected_uri(server_uri: str, port: int) -> str:
+    """Gets the URI of another process of the same server, on the same host"""
+    uri = urlsplit(server_uri)
+    return urlunsplit(uri._replace(netloc=f"{uri.hostname}:{port}"))
+
+def parse_rules(options: list[str]) -> Optional[dict[str, int]]:
+    """Reads the board size and connect length typed after CREATE, such as `10x8 5`
+
+    Returns:
+        The arguments for the "create" message, or None if the options could not be read
+    """
+    arguments = {}
+    try:
+        if options:
+            columns, _, rows = options[0].lower().partition("x")
+            arguments["columns"] = int(columns)
+            arguments["rows"] = int(rows)
+        if len(options) > 1:
+            arguments["connect"] = int(options[1])
+    except ValueError:
+        return None
+
+    return arguments if len(options) <= 2 else None
 
 class ClientGrid:
-    __slots__ = ("rows", "columns", "client_player", "current_player", "inner")
+    __slots__ = (
+        "rows", "columns", "connect", "client_player", "current_player", "inner", "seq", "resyncing", "token", "error",
+        "rendered", "changed", "redraw",
+    )
 
     rows: int
     columns: int
+    # The number of pieces in a row needed to win
+    connect: int
     client_player: Cell
     current_player: Cell
 
+    # The seq of the last update applied, see MOVE_APPLIED in protocol.txt
+    seq: int
+    # If a RESYNC has been sent and the BOARD_UPDATE has not arrived yet
+    resyncing: bool
+    # The session token to resume the game with if the connection drops, None for spectators
+    token: Optional[str]
+    # Why the server rejected the last move, shown under the board until the next update
+    error: Optional[str]
+
     # row = inner[i]
     # cell = inner[i][i]
     inner: list[list[Cell]]
 
+    # The text of each row, None if a cell in it has changed since it was last rendered
+    rendered: list[Optional[str]]
+    # The (row, column) of every cell placed since the screen was last drawn
+    changed: list[tuple[int, int]]
+    # If the whole screen has to be drawn again, such as before the first draw or after a BOARD_UPDATE
+    redraw: bool
+
     def __init__(self, game_start: GameStart, client_player: Cell) -> None:
         self.rows = game_start.rows
         self.columns = game_start.columns
-        self.client_player = client_player
+        self.connect = game_start.connect
+        # Told by the server, as a quick match can put this player on either side
+        self.client_player = client_player if game_start.player is None else game_start.player
         self.current_player = Cell.RED_PLAYER
         self.inner = [[Cell.EMPTY for _ in range(self.columns)] for _ in range(self.rows)]
+        self.seq = 0
+        self.resyncing = False
+        self.token = game_start.token
+        self.error = None
+        self.rendered = [None] * self.rows
+        self.changed = []
+        self.redraw = True
 
     def __str__(self) -> str:
-        # Start off with a line of indexes
-        out = " " + "  ".join(map(str, range(1, self.columns + 1))) + "\n"
+        # Start off with a line of indexes, centred over each cell so wide boards still line up
+        header = "".join(f"{index:^{CELL_WIDTH}}" for index in range(1, self.columns + 1))
+        return "\n".join((header, *map(self.render_row, range(self.rows)))) + "\n"
+
+    def render_row(self, row: int) -> str:
+        if (text := self.rendered[row]) is None:
+            text = self.rendered[row] = "".join(f"{cell} " for cell in self.inner[row])
+
+        return text
+
+    def place(self, row: int, column: int, player: Cell):
+        self.inner[row][column] = player
+        self.rendered[row] = None
+        self.changed.append((row, column))
+
+    def draw(self):
+        """Brings the screen up to date with the board, leaving the cursor on the line under it
+
+        The whole screen is only drawn the first time and after a BOARD_UPDATE,
+        otherwise the cursor is moved to each cell placed since the last draw to
+        repaint just that cell. Anything printed under the board is cleared.
+        """
+        # A board taller than the terminal scrolls it, so the cells are no longer where they were drawn
+        if self.redraw or BOARD_TOP + self.rows > shutil.get_terminal_size().lines:
+            frame = f"{CLEAR_SCREEN}Connect {self.connect}\n{self}"
+        else:
+            cells = "".join(
+                f"\33[{BOARD_TOP + row};{column * CELL_WIDTH + 1}H{self.inner[row][column]}"
+                for row, column in self.changed
+            )
+            frame = f"{cells}\33[{BOARD_TOP + self.rows};1H\33[J"
+
+        self.redraw = False
+        self.changed.clear()
+
+        # Written in one go, so the terminal never shows half an update
+        sys.stdout.write(frame)
+        sys.stdout.flush()
+
+
+    async def apply_update(
+        self, update: pydantic.BaseModel, connection: Connection
+    ) -> Optional[Union[MoveApplied, BoardUpdate, Forfeit, Error]]:
+        """Applies a message from the server to the board
+
+        If a move has been missed, a RESYNC is sent and moves are ignored until
+        the full board arrives.
+
+        Returns:
+            The update, or None if it was ignored
+        """
+        if isinstance(update, (Forfeit, Error)):
+            return update
+        elif isinstance(update, BoardUpdate):
+            self.inner = update.board
+            self.rendered = [None] * self.rows
+            self.redraw = True
+            self.resyncing = False
+        else:
+            assert isinstance(update, MoveApplied)
+            if self.resyncing or update.seq <= self.seq:
+                # Already included in the board we have, or will be in the one we asked for
+                return None
 
-        # Loop through each column and row, concatenating each cell
-        for column in self.inner:
-            for cell in column:
-                out += f"{cell} "
+            if update.seq != self.seq + 1:
+                self.resyncing = True
+                await connection.send(ClientServerMessage(c = "resync", a = {}))
+                return None
 
-            out += "\n"
+            self.place(update.row, update.column, update.player)
 
-        return out
+        self.seq = update.seq
+        # Red always goes first, so the turn can be worked out from the number of turns taken
+        self.current_player = Cell.RED_PLAYER if self.seq % 2 == 0 else Cell.YELLOW_PLAYER
+        return update
 
+    async def wait_for_update(self, connection: Connection) -> Union[MoveApplied, BoardUpdate, Forfeit, Error]:
+        """Waits for the next move and applies it to the board"""
+        while True:
+            if (update := await self.apply_update(await connection.recv(), connection)) is not None:
+                return update
+
+    async def take_turn(
+        self, connection: Connection, keyboard: Keyboard
+    ) -> Optional[Union[MoveApplied, BoardUpdate, Forfeit, Error]]:
+        """Asks for a move if it is this player's turn, then waits for the next update
+
+        Returns:
+            The update, or None if the column entered was invalid and should be asked for again,
+            or if the server sent something which changed nothing while waiting for the move
+        """
+        if self.current_player == self.client_player:
+            index = await keyboard.input(f"{self.current_player} Column to drop piece on: ", connection)
+            if not isinstance(index, str):
+                # Pushed by the server before a move was typed, such as the other player leaving
+                return await self.apply_update(index, connection)
 
-    def swap_current_player(self):
-        assert self.current_player != Cell.EMPTY
+            try:
+                index = int(index) - 1
+            except ValueError:
+                return None
+
+            # The server would reject these, so save the round trip
+            if not 0 <= index < self.columns or self.inner[0][index] != Cell.EMPTY:
+                return None
+
+            await connection.send(ClientServerMessage(
+                c = "play_piece",
+                a = {"column": index}
+            ))
+
+        return await self.wait_for_update(connection)
+
+    async def play(
+        self,
+        connection: Connection,
+        keyboard: Keyboard,
+        reconnect: Optional[Callable[[str, int], Awaitable[Optional[Connection]]]] = None,
+    ):
+        """Plays or watches the game until it ends
+
+        Args:
+            keyboard: Where moves are typed, while still listening to the server.
+            reconnect: Called with the session token and last seq if the connection drops,
+                returning the new connection or None if the game is over.
+        """
+        while True:
+            self.draw()
+            if self.error is not None:
+                print(self.error)
+                self.error = None
 
-        match self.current_player:
-            case Cell.RED_PLAYER:
-                self.current_player = Cell.YELLOW_PLAYER
-            case Cell.YELLOW_PLAYER:
-                self.current_player = Cell.RED_PLAYER
+            try:
+                update = await self.take_turn(connection, keyboard)
+            except ConnectionClosed:
+                if reconnect is None or self.token is None:
+                    raise
+
+                self.draw()
+                print("Connection lost, reconnecting...")
+                new_connection = await reconnect(self.token, self.seq)
+                if new_connection is None:
+                    print("Could not get back into the game, it has finished")
+                    break
+
+                connection = new_connection
+                continue
+
+            if update is None:
+                continue
+
+            if isinstance(update, Error):
+                self.error = update.error
+                continue
+
+            if isinstance(update, Forfeit):
+                self.draw()
+                if update.player == self.client_player:
+                    print("You took too long and forfeited the game!")
+                else:
+                    winner = update.player.swap()
+                    print(f"{update.player.player_name()} left the game, {winner} {winner.player_name()} wins!")
+                break
 
-    async def wait_for_update(self, connection: WebSocketClientProtocol) -> bool:
-        board_update = BoardUpdate.parse_raw(await connection.recv())
-        self.inner = board_update.board
-        return board_update.game_end
+            if update.draw:
+                self.draw()
+                print("The board is full, it's a draw!")
+                break
 
-    async def play(self, connection: WebSocketClientProtocol):
-        while True:
-            clear_screen()
-            print(self)
-            if self.current_player == self.client_player:
-                index = await ainput(f"{self.current_player} Column to drop piece on: ")
+            if update.game_end:
+                # Do one more refresh to show winning play
+                self.draw()
 
-                try:
-                    index = int(index) - 1
-                except ValueError:
-                    continue
+                # The turn has already passed on from the player who won
+                winner = self.current_player.swap()
+                player_name = winner.player_name()
 
-                if index >= self.columns:
-                    continue
+                print(f"{winner} {player_name} wins!")
+                break
 
-                await connection.send(ClientServerMessage(
-                    c = "play_piece",
-                    a = {"column": index}
-                ).json())
+def apply_lobby_update(rooms: dict[int, str], update: LobbyUpdate):
+    for room_id in update.removed:
+        rooms.pop(room_id, None)
 
-            # Returns true on game end
-            if await self.wait_for_update(connection):
-                # Do one more refresh to show winning play
-                clear_screen()
+    rooms.update(update.added)
 
-                current_player = self.current_player
-                player_name = current_player.player_name()
+async def resume(username: str, server_uri: str, token: str, seq: int) -> Optional[Connection]:
+    """Logs back in to a game after the connection dropped, retrying while the server is unreachable
 
-                print(f"{self}\n{current_player} {player_name} wins!")
-                break
+    Returns:
+        The new connection, which has been sent GAME_START, or None if the game is over
+    """
+    for _ in range(RECONNECT_ATTEMPTS):
+        try:
+            websocket = await connect(server_uri)
+        except OSError:
+            await asyncio.sleep(1)
+            continue
 
-            self.swap_current_player()
+        await websocket.send(ClientServerMessage(
+            c = "login",
+            a = {"username": username, "encoding": Encoding.BINARY.value, "token": token, "seq": seq}
+        ).json())
 
-async def main(username: str, server_uri: str):
-    async with connect(server_uri) as server_connection:
-        await server_connection.send(ClientServerMessage(
+        first_response = await websocket.recv()
+        encoding = Encoding.BINARY if isinstance(first_response, bytes) else Encoding.JSON
+
+        response = decode_message(first_response)
+        if isinstance(response, GameStart):
+            return Connection(websocket, encoding)
+
+        await websocket.close()
+        if not isinstance(response, Redirect):
+            # Put in the lobby, as the game has finished
+            return None
+
+        # The game is on another process of the same server
+        server_uri = redirected_uri(server_uri, response.port)
+
+    return None
+
+async def main(
+    username: str,
+    server_uri: str,
+    redirected_room: Optional[int] = None,
+    redirected_quick_match: Optional[str] = None,
+    keyboard: Optional[Keyboard] = None,
+):
+    """Logs in and runs the lobby until a game is played
+
+    Rooms opening and closing are shown as the server pushes them, even while
+    waiting for a command to be typed.
+
+    Args:
+        redirected_room: The room to join straight away, after being redirected to the server process that owns it.
+        redirected_quick_match: The options typed after QUICK, to ask for a quick match with straight away
+            after being redirected to the server process that matches players with those rules.
+        keyboard: Kept when redirected, so nothing already typed is lost.
+    """
+    if keyboard is None:
+        keyboard = Keyboard()
+
+    async with connect(server_uri) as websocket:
+        await websocket.send(ClientServerMessage(
             c = "login",
-            a = {"username": username}
+            a = {"username": username, "encoding": Encoding.BINARY.value}
         ).json())
 
-        current_rooms = CurrentRooms.parse_raw(await server_connection.recv())
+        # Servers without binary support ignore the request and reply in JSON,
+        # so only switch to binary once the server has replied in it
+        first_response = await websocket.recv()
+        encoding = Encoding.BINARY if isinstance(first_response, bytes) else Encoding.JSON
+        server_connection = Connection(websocket, encoding)
+
+        current_rooms = decode_message(first_response)
+        if isinstance(current_rooms, Error):
+            print(f"Could not log in: {current_rooms.error}")
+            return
+
+        assert isinstance(current_rooms, CurrentRooms)
+        rooms = current_rooms.rooms
+        # If the running games are listed to spectate, instead of the rooms to join
+        viewing_games = False
+        # Why the server rejected the last command, if it did
+        error = None
+        # The options typed after the last QUICK, to ask again if redirected
+        quick_match = None
         while True:
             clear_screen()
-            print("Current Open Rooms")
-            for room_id, username in current_rooms.rooms.items():
+            listing = "Running Games" if viewing_games else "Current Open Rooms"
+            print(f"{listing} (page {current_rooms.page + 1} of {current_rooms.pages})")
+            for room_id, username in rooms.items():
                 print(f"{room_id}: {username}")
 
-            room_to_join = await ainput("Choose the room number to join or type CREATE: ")
+            if error is not None:
+                print(error)
+                error = None
+
+            if redirected_room is not None:
+                room_to_join, redirected_room = str(redirected_room), None
+            elif redirected_quick_match is not None:
+                room_to_join, redirected_quick_match = f"QUICK {redirected_quick_match}", None
+            else:
+                if viewing_games:
+                    question = (
+                        "Choose the game number to watch, type ROOMS to go back to the rooms, "
+                        "NEXT or PREV to change page, or press enter to refresh: "
+                    )
+                else:
+                    question = (
+                        "Choose the room number to join, type CREATE (or CREATE COLUMNSxROWS CONNECT for "
+                        "another size, such as CREATE 10x8 5), type QUICK to play whoever is next to look for "
+                        "a game (with the same options as CREATE), type BOT to play the computer, "
+                        "GAMES to watch a game, NEXT or PREV to change page, or press enter to refresh: "
+                    )
+
+                room_to_join = await keyboard.input(question, server_connection)
+                if isinstance(room_to_join, LobbyUpdate):
+                    # Redrawn straight away, anything half typed is still there for when enter is pressed
+                    if not viewing_games:
+                        apply_lobby_update(rooms, room_to_join)
+                    continue
+                elif isinstance(room_to_join, Error):
+                    error = room_to_join.error
+                    continue
+                elif not isinstance(room_to_join, str):
+                    # Nothing else is sent to the lobby without being asked for
+                    continue
+
             try:
                 room_to_join = int(room_to_join)
             except ValueError:
-                if room_to_join.upper() != "CREATE":
+                command, *options = room_to_join.upper().split() or [""]
+                if command in ("", "NEXT", "PREV"):
+                    page_offset = {"": 0, "NEXT": 1, "PREV": -1}[command]
+                    await server_connection.send(ClientServerMessage(
+                        c = "games" if viewing_games else "rooms",
+                        a = {"page": current_rooms.page + page_offset},
+                    ))
+                elif command in ("GAMES", "ROOMS"):
+                    viewing_games = command == "GAMES"
+                    await server_connection.send(ClientServerMessage(
+                        c = command.lower(),
+                        a = {"page": 0},
+                    ))
+                elif command in ("CREATE", "BOT"):
+                    client_player = Cell.RED_PLAYER
+                    against_bot = command == "BOT"
+                    arguments = {"bot": True} if against_bot else parse_rules(options)
+                    if arguments is None:
+                        continue
+
+                    if not against_bot:
+                        clear_screen()
+                        print("Waiting for a connection...")
+
+                    await server_connection.send(ClientServerMessage(
+                        c = "create",
+                        a = arguments,
+                    ))
+                elif command == "QUICK":
+                    arguments = parse_rules(options)
+                    if arguments is None:
+                        continue
+
+                    # The side played is in GAME_START
+                    client_player = Cell.EMPTY
+                    quick_match = " ".join(options)
+                    clear_screen()
+                    print("Looking for an opponent...")
+
+                    await server_connection.send(ClientServerMessage(
+                        c = "quick_match",
+                        a = arguments,
+                    ))
+                else:
                     continue
-
-                client_player = Cell.RED_PLAYER
-                clear_screen()
-                print("Waiting for a connection...")
-                await server_connection.send(ClientServerMessage(
-                    c = "create",
-                    a = {},
-                ).json())
             else:
-                client_player = Cell.YELLOW_PLAYER
+                if viewing_games:
+                    # Spectators are neither player, so are never asked for a move
+                    client_player = Cell.EMPTY
+                else:
+                    client_player = Cell.YELLOW_PLAYER
+
                 await server_connection.send(ClientServerMessage(
-                    c = "connect",
+                    c = "spectate" if viewing_games else "connect",
                     a = {},
                     t = room_to_join
-                ).json())
+                ))
+
+            # Rooms opening and closing are pushed while in the lobby, so apply any
+            # of those that arrived before the reply
+            response = await server_connection.recv()
+            while isinstance(response, LobbyUpdate):
+                if not viewing_games:
+                    apply_lobby_update(rooms, response)
+
+                response = await server_connection.recv()
 
             # The server may send back a CURRENT_ROOMS payload if the room we
             # are connecting to is invalid, otherwise it is a GAME_START
-            response = json.loads(await server_connection.recv())
-            if "rows" in response:
-                game_start = GameStart.parse_obj(response)
-                grid = ClientGrid(game_start, client_player)
-
-                return await grid.play(server_connection)
+            if isinstance(response, GameStart):
+                grid = ClientGrid(response, client_player)
+
+                return await grid.play(
+                    server_connection, keyboard, lambda token, seq: resume(username, server_uri, token, seq)
+                )
+            elif isinstance(response, Redirect):
+                # The room is owned by another process of the same server, on the same host
+                redirect = response
+                break
+            elif isinstance(response, Error):
+                error = response.error
             else:
-                current_rooms = CurrentRooms.parse_obj(response)
-
-with open("last_credentials.json", "r+") as last_creds_file:
-    last_creds_raw = last_creds_file.read()
-    if last_creds_raw == "":
-        saved_username = formatted_username = ""
-        saved_server_uri = formatted_server_uri = ""
-    else:
-        last_creds_file.seek(0)
-        last_creds = json.loads(last_creds_raw)
+                assert isinstance(response, CurrentRooms)
+                current_rooms = response
+                rooms = current_rooms.rooms
+
+    # Only quick matches are redirected without a room
+    redirected_quick_match = quick_match if redirect.t is None else None
+    return await main(
+        username, redirected_uri(server_uri, redirect.port), redirect.t, redirected_quick_match, keyboard
+    )
+
+if __name__ == "__main__":
+    with open("last_credentials.json", "r+") as last_creds_file:
+        last_creds_raw = last_creds_file.read()
+        if last_creds_raw == "":
+            saved_username = formatted_username = ""
+            saved_server_uri = formatted_server_uri = ""
+        else:
+            last_creds_file.seek(0)
+            last_creds = json.loads(last_creds_raw)
 
-        saved_username = last_creds["username"]
-        saved_server_uri = last_creds["server_uri"]
+            saved_username = last_creds["username"]
+            saved_server_uri = last_creds["server_uri"]
 
-        formatted_username = f" ({saved_username})"
-        formatted_server_uri = f" ({saved_server_uri})"
+            formatted_username = f" ({saved_username})"
+            formatted_server_uri = f" ({saved_server_uri})"
 
-    while True:
-        username = input(f"Enter your username{formatted_username}: ") or saved_username
-        server_uri = input(f"Enter the URI of the server{formatted_server_uri}: ") or saved_server_uri
+        while True:
+            username = input(f"Enter your username{formatted_username}: ") or saved_username
+            server_uri = input(f"Enter the URI of the server{formatted_server_uri}: ") or saved_server_uri
 
-        if username and server_uri:
-            break
-        else:
-            print("Please enter both a username and server_uri!")
+            if username and server_uri:
+                break
+            else:
+                print("Please enter both a username and server_uri!")
 
-    json.dump({"username": username, "server_uri": server_uri}, last_creds_file)
+        json.dump({"username": username, "server_uri": server_uri}, last_creds_file)
 
-asyncio.run(main(username, server_uri))
+    asyncio.run(main(username, server_uri))
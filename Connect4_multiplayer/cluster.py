@@ -0,0 +1,244 @@
+"""Running the server as many processes, each owning a share of the rooms
+
+The shards talk to a coordinator with newline separated JSON over a Unix socket.
+
+Shard -> Coordinator:
+HELLO = {"op": "hello", "shard": SHARD, "port": PORT}
+OPEN = {"op": "open", "id": REQUEST_ID, "username": USERNAME}
+CLOSE = {"op": "close", "room_id": ROOM_ID}
+RELEASE = {"op": "release", "room_id": ROOM_ID}
+
+Coordinator -> Shard:
+SNAPSHOT = {"event": "snapshot", "rooms": {room_id: [SHARD, USERNAME]}, "ports": {shard: PORT}}
+OPENED = {"id": REQUEST_ID, "room_id": ROOM_ID}
+SHARD = {"event": "shard", "shard": SHARD, "port": PORT}
+ADDED = {"event": "added", "room_id": ROOM_ID, "shard": SHARD, "username": USERNAME}
+REMOVED = {"event": "removed", "room_id": ROOM_ID}
+"""
+
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import secrets
+from typing import Any, Optional
+
+from lobby import Lobby
+from matchmaking import key_owner
+from rooms import IdAllocator
+
+SOCKET_PATH = "connect4-coordinator.sock"
+
+
+def write_line(writer: asyncio.StreamWriter, message: dict[str, Any]):
+    writer.write(json.dumps(message).encode() + b"\n")
+
+
+class Coordinator:
+    """Holds the directory of open rooms for every shard of a sharded server
+
+    Runs in the parent process and is the only place room ids are allocated, so
+    ids are unique across every shard. Each change to the directory is sent to
+    every shard, so they can each list every open room in their own lobby.
+    """
+
+    __slots__ = ("ids", "rooms", "ports", "writers")
+
+    ids: IdAllocator
+    # room id = (shard, username) for every open room
+    rooms: dict[int, tuple[int, str]]
+    # shard = port that shard can be reached on directly
+    ports: dict[int, int]
+    writers: dict[int, asyncio.StreamWriter]
+
+    def __init__(self) -> None:
+        self.ids = IdAllocator()
+        self.rooms = {}
+        self.ports = {}
+        self.writers = {}
+
+    def broadcast(self, message: dict[str, Any]):
+        for writer in self.writers.values():
+            write_line(writer, message)
+
+    async def handle_shard(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        shard = None
+        try:
+            async for line in reader:
+                message = json.loads(line)
+
+                match message["op"]:
+                    case "hello":
+                        shard = message["shard"]
+                        self.ports[shard] = message["port"]
+                        self.broadcast({"event": "shard", "shard": shard, "port": message["port"]})
+
+                        self.writers[shard] = writer
+                        write_line(writer, {"event": "snapshot", "rooms": self.rooms, "ports": self.ports})
+                    case "open":
+                        assert shard is not None
+
+                        room_id = self.ids.allocate()
+                        self.rooms[room_id] = (shard, message["username"])
+
+                        write_line(writer, {"id": message["id"], "room_id": room_id})
+                        self.broadcast({
+                            "event": "added", "room_id": room_id, "shard": shard, "username": message["username"]
+                        })
+                    case "close":
+                        if self.rooms.pop(message["room_id"], None) is not None:
+                            self.broadcast({"event": "removed", "room_id": message["room_id"]})
+                    case "release":
+                        self.ids.release(message["room_id"])
+        finally:
+            if shard is not None:
+                self.writers.pop(shard, None)
+
+                # The players waiting in this shard's rooms have been disconnected
+                for room_id, (owner, _) in list(self.rooms.items()):
+                    if owner == shard:
+                        del self.rooms[room_id]
+                        self.ids.release(room_id)
+                        self.broadcast({"event": "removed", "room_id": room_id})
+
+    async def serve(self, path: str = SOCKET_PATH):
+        server = await asyncio.start_unix_server(self.handle_shard, path)
+        async with server:
+            await server.serve_forever()
+
+
+class ShardDirectory:
+    """Allocates room ids and lists open rooms through the `Coordinator`
+
+    This has the same methods as `rooms.LocalDirectory`, so the server does not
+    need to know if it is running as a shard or on its own.
+    """
+
+    __slots__ = (
+        "lobby", "shard", "port", "reader", "writer", "events", "snapshot", "owners", "ports", "requests",
+        "request_ids",
+    )
+
+    lobby: Lobby
+    shard: int
+    # The port this shard can be reached on directly
+    port: int
+
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    # Reads events from the coordinator, finishing when the coordinator exits
+    events: asyncio.Task[None]
+    # Resolved once the first snapshot has arrived, and the rooms and shards are known
+    snapshot: asyncio.Future[None]
+
+    # room id = shard, for every open room
+    owners: dict[int, int]
+    # shard = port, for every shard
+    ports: dict[int, int]
+
+    # Requests waiting for a reply from the coordinator, by request id
+    requests: dict[int, asyncio.Future[dict[str, Any]]]
+    request_ids: itertools.count
+
+    def __init__(self, lobby: Lobby, shard: int, port: int) -> None:
+        self.lobby = lobby
+        self.shard = shard
+        self.port = port
+        self.owners = {}
+        self.ports = {}
+        self.requests = {}
+        self.request_ids = itertools.count()
+
+    async def connect(self, path: str = SOCKET_PATH):
+        """Connects to the coordinator, retrying while it starts up, then waits for the snapshot
+
+        Waiting means the shard never serves players while it knows of no other shards,
+        where it would match quick match players that another shard should have.
+        """
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+
+        write_line(self.writer, {"op": "hello", "shard": self.shard, "port": self.port})
+        self.snapshot = asyncio.get_running_loop().create_future()
+        self.events = asyncio.create_task(self.read_events())
+
+        # The events finish without a snapshot if the coordinator exits first
+        await asyncio.wait((self.snapshot, self.events), return_when=asyncio.FIRST_COMPLETED)
+
+    async def read_events(self):
+        async for line in self.reader:
+            message = json.loads(line)
+
+            if "id" in message:
+                self.requests.pop(message["id"]).set_result(message)
+                continue
+
+            match message["event"]:
+                case "snapshot":
+                    self.ports.update({int(shard): port for shard, port in message["ports"].items()})
+                    for room_id, (shard, username) in message["rooms"].items():
+                        self.owners[int(room_id)] = shard
+                        self.lobby.room_added(int(room_id), username)
+
+                    if not self.snapshot.done():
+                        self.snapshot.set_result(None)
+                case "shard":
+                    self.ports[message["shard"]] = message["port"]
+                case "added":
+                    self.owners[message["room_id"]] = message["shard"]
+                    self.lobby.room_added(message["room_id"], message["username"])
+                case "removed":
+                    self.owners.pop(message["room_id"], None)
+                    self.lobby.room_removed(message["room_id"])
+
+    async def open(self, username: str) -> int:
+        request_id = next(self.request_ids)
+        self.requests[request_id] = reply = asyncio.get_running_loop().create_future()
+
+        write_line(self.writer, {"op": "open", "id": request_id, "username": username})
+        return (await reply)["room_id"]
+
+    def close(self, room_id: int):
+        write_line(self.writer, {"op": "close", "room_id": room_id})
+
+    def release(self, room_id: int):
+        write_line(self.writer, {"op": "release", "room_id": room_id})
+
+    def owner_port(self, room_id: int) -> Optional[int]:
+        owner = self.owners.get(room_id)
+        if owner is None or owner == self.shard:
+            return None
+
+        return self.ports.get(owner)
+
+    def new_token(self) -> str:
+        # Prefixed with the shard, so other shards know where to send the player back to
+        return f"{self.shard}.{secrets.token_hex(16)}"
+
+    def session_port(self, token: str) -> Optional[int]:
+        shard, _, _ = token.partition(".")
+        if not shard.isdigit() or int(shard) == self.shard:
+            return None
+
+        return self.ports.get(int(shard))
+
+    def match_port(self, key: str) -> Optional[int]:
+        # No shards are known before the snapshot, so match here rather than nowhere
+        if not self.ports:
+            return None
+
+        owner = key_owner(key, sorted(self.ports))
+        return None if owner == self.shard else self.ports[owner]
+
+
+def run_coordinator(path: str = SOCKET_PATH):
+    # Left behind if the last coordinator was killed
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+
+    asyncio.run(Coordinator().serve(path))
@@ -0,0 +1,276 @@
+"""An append-only log of finished games, split over numbered segment files
+
+Each segment starts with a SEGMENT_HEADER, followed by one record per game:
+RECORD = length of the rest of the record u32, room id i32 (-1 for bot games),
+    finished at f64 (unix time), rows u16, columns u16, connect u8, result u8,
+    bot u8, red username length u8, yellow username length u8, number of moves
+    u32, then the usernames and the column of every move as u8, as boards are
+    at most 255 columns wide.
+
+A record cut short by a crash can only be at the end of the newest segment,
+and is skipped by `replay`.
+"""
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import struct
+import time
+from array import array
+from enum import IntEnum
+from pathlib import Path
+from typing import BinaryIO, Iterator, NamedTuple, Optional
+
+from shared import Cell
+
+GAME_LOG_PATH = "game_log"
+# Segments are rotated once they reach this size
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# magic, format version
+SEGMENT_HEADER = struct.Struct("<4sB")
+MAGIC = b"C4GL"
+VERSION = 1
+RECORD_LENGTH = struct.Struct("<I")
+RECORD = struct.Struct("<idHHBBBBBI")
+
+
+class Result(IntEnum):
+    RED_WIN = 0
+    YELLOW_WIN = 1
+    DRAW = 2
+    RED_FORFEIT = 3
+    YELLOW_FORFEIT = 4
+
+
+class GameRecord(NamedTuple):
+    # None for games against the bot, which have no room
+    room_id: Optional[int]
+    red: str
+    yellow: str
+    rows: int
+    columns: int
+    connect: int
+    # The column of every turn in order, red first
+    moves: list[int]
+    result: Result
+    # The player played by the bot, if any
+    bot: Optional[Cell]
+    finished_at: float
+
+    def encode(self) -> bytes:
+        # Usernames are capped at login, but any cut drops a character cut in half to keep it valid UTF-8
+        red = self.red.encode()[:255].decode(errors="ignore").encode()
+        yellow = self.yellow.encode()[:255].decode(errors="ignore").encode()
+        moves = array("B", self.moves).tobytes()
+
+        body = RECORD.pack(
+            -1 if self.room_id is None else self.room_id,
+            self.finished_at,
+            self.rows,
+            self.columns,
+            self.connect,
+            self.result,
+            0 if self.bot is None else self.bot.value,
+            len(red),
+            len(yellow),
+            len(self.moves),
+        ) + red + yellow + moves
+
+        return RECORD_LENGTH.pack(len(body)) + body
+
+    @classmethod
+    def decode(cls, body: bytes) -> "GameRecord":
+        room_id, finished_at, rows, columns, connect, result, bot, red_length, yellow_length, move_count = (
+            RECORD.unpack_from(body)
+        )
+        offset = RECORD.size
+
+        # Replaced rather than raising, so one bad username cannot stop a replay
+        red = body[offset:offset + red_length].decode(errors="replace")
+        offset += red_length
+        yellow = body[offset:offset + yellow_length].decode(errors="replace")
+        offset += yellow_length
+
+        moves = array("B", body[offset:offset + move_count])
+
+        return cls(
+            None if room_id == -1 else room_id,
+            red,
+            yellow,
+            rows,
+            columns,
+            connect,
+            moves.tolist(),
+            Result(result),
+            None if bot == 0 else Cell(bot),
+            finished_at,
+        )
+
+
+class SegmentWriter:
+    """Appends encoded records to the newest segment, only ever used from one thread at a time"""
+
+    __slots__ = ("directory", "prefix", "segment_size", "number", "file")
+
+    directory: Path
+    # Segments are named "{prefix}-{number}.log", shards each use their own prefix
+    prefix: str
+    segment_size: int
+    number: int
+    file: Optional[BinaryIO]
+
+    def __init__(self, directory: Path, prefix: str, segment_size: int) -> None:
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_size = segment_size
+        self.file = None
+
+        existing = sorted(directory.glob(f"{prefix}-*.log"))
+        self.number = int(existing[-1].stem.rpartition("-")[2]) if existing else 0
+
+    def open_segment(self):
+        self.number += 1
+        self.file = open(self.directory / f"{self.prefix}-{self.number:06d}.log", "ab")
+        self.file.write(SEGMENT_HEADER.pack(MAGIC, VERSION))
+
+    def write(self, data: bytes):
+        # Always start a new segment after a restart, so a cut short record is only ever at the end of one
+        if self.file is None or self.file.tell() >= self.segment_size:
+            self.close()
+            self.open_segment()
+
+        self.file.write(data)
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class GameLog:
+    """Records finished games without blocking the event loop on disk I/O
+
+    `append` only adds the game to a list. A background task takes everything
+    added since its last write and encodes and writes it as one batch in a
+    thread, so a burst of games finishing costs a single write.
+    """
+
+    __slots__ = ("writer", "pending", "interval", "wakeup", "lock", "task")
+
+    writer: SegmentWriter
+    # Games waiting to be written
+    pending: list[GameRecord]
+    # Seconds to wait between batches, to collect more games in each one
+    interval: float
+    wakeup: asyncio.Event
+    # Held while writing, so batches are written in order and never at the same time
+    lock: asyncio.Lock
+    task: Optional[asyncio.Task[None]]
+
+    def __init__(
+        self,
+        directory: str = GAME_LOG_PATH,
+        prefix: str = "games",
+        segment_size: int = SEGMENT_SIZE,
+        interval: float = 1.0,
+    ) -> None:
+        path = Path(directory)
+        path.mkdir(parents=True, exist_ok=True)
+
+        self.writer = SegmentWriter(path, prefix, segment_size)
+        self.pending = []
+        self.interval = interval
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.write_batches())
+
+    def append(self, record: GameRecord):
+        self.pending.append(record)
+        self.wakeup.set()
+
+    def write_batch(self, batch: list[GameRecord]):
+        """Encodes and writes a batch of games, run in a thread"""
+        self.writer.write(b"".join(record.encode() for record in batch))
+
+    async def flush(self):
+        async with self.lock:
+            batch, self.pending = self.pending, []
+            if batch:
+                await asyncio.to_thread(self.write_batch, batch)
+
+    async def write_batches(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+
+            # Shielded, so a batch already taken from `pending` is still written if the log is closed
+            await asyncio.shield(self.flush())
+            await asyncio.sleep(self.interval)
+
+    async def close(self):
+        """Writes any games still waiting and closes the log"""
+        if self.task is not None:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+
+        await self.flush()
+        await asyncio.to_thread(self.writer.close)
+
+
+def replay(directory: str = GAME_LOG_PATH, prefix: str = "*") -> Iterator[GameRecord]:
+    """Reads every game back from the log, oldest segment first
+
+    Only one segment is held in memory at a time, so this works over logs far
+    larger than memory.
+
+    Args:
+        directory: The directory the segments are in.
+        prefix: Only reads segments with this prefix, by default every shard's.
+    """
+    for segment in sorted(Path(directory).glob(f"{prefix}-*.log")):
+        data = segment.read_bytes()
+
+        magic, version = SEGMENT_HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{segment} is not a version {VERSION} game log")
+
+        offset = SEGMENT_HEADER.size
+        while offset + RECORD_LENGTH.size <= len(data):
+            (length,) = RECORD_LENGTH.unpack_from(data, offset)
+            offset += RECORD_LENGTH.size
+            if offset + length > len(data):
+                # Cut short by a crash while writing
+                break
+
+            yield GameRecord.decode(data[offset:offset + length])
+            offset += length
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarises the games in a game log")
+    parser.add_argument("directory", nargs="?", default=GAME_LOG_PATH)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results: collections.Counter[Result] = collections.Counter()
+    sizes: collections.Counter[tuple[int, int, int]] = collections.Counter()
+    moves = 0
+
+    for record in replay(args.directory):
+        results[record.result] += 1
+        sizes[record.rows, record.columns, record.connect] += 1
+        moves += len(record.moves)
+
+    games = sum(results.values())
+    print(f"{games} games with {moves} moves, read in {time.perf_counter() - start:.2f}s")
+    for result, count in results.most_common():
+        print(f"{result.name.replace('_', ' ').title()}: {count}")
+    for (rows, columns, connect), count in sizes.most_common():
+        print(f"{columns}x{rows} board, connect {connect}: {count}")
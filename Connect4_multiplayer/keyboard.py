@@ -0,0 +1,136 @@
+"""Reads lines typed into the terminal on the event loop, so the client can wait for the keyboard and the server at once
+
+On Linux stdin is watched with `loop.add_reader`, and each line is queued as
+soon as enter is pressed, with no thread involved. Event loops without
+add_reader (the proactor loop on Windows) and stdin redirected from a file,
+which cannot be watched, fall back to a single thread reading for the whole
+run instead of one per prompt.
+"""
+
+import asyncio
+import collections
+import os
+import sys
+import threading
+from typing import Optional, Union
+
+import pydantic
+
+from shared import Connection
+
+
+class Keyboard:
+    __slots__ = ("lines", "ready", "partial", "loop", "watching")
+
+    # Lines typed but not read yet, ending with None once stdin is closed
+    lines: collections.deque[Optional[str]]
+    # Set whenever a line is queued
+    ready: asyncio.Event
+    # The start of a line which has been read without its newline yet
+    partial: bytes
+    loop: asyncio.AbstractEventLoop
+    # If stdin is watched by the event loop, otherwise a thread is reading it
+    watching: bool
+
+    def __init__(self) -> None:
+        self.lines = collections.deque()
+        self.ready = asyncio.Event()
+        self.partial = b""
+        self.loop = asyncio.get_running_loop()
+
+        try:
+            self.loop.add_reader(sys.stdin.fileno(), self.on_readable)
+            self.watching = True
+        except (NotImplementedError, PermissionError):
+            # Daemon, so a thread stuck waiting for a line does not stop the client from exiting
+            threading.Thread(target=self.read_in_thread, daemon=True).start()
+            self.watching = False
+
+    def push(self, line: Optional[str]):
+        self.lines.append(line)
+        self.ready.set()
+
+    def on_readable(self):
+        data = os.read(sys.stdin.fileno(), 4096)
+        if not data:
+            self.close()
+            if self.partial:
+                self.push(self.partial.decode(errors="replace"))
+            self.push(None)
+            return
+
+        # Only split into lines before decoding, so a character cut in half between reads is kept whole
+        *lines, self.partial = (self.partial + data).split(b"\n")
+        for line in lines:
+            self.push(line.decode(errors="replace").rstrip("\r"))
+
+    def read_in_thread(self):
+        while line := sys.stdin.readline():
+            self.loop.call_soon_threadsafe(self.push, line.rstrip("\r\n"))
+
+        self.loop.call_soon_threadsafe(self.push, None)
+
+    def unread(self, line: str):
+        """Puts a line back, to be the next one read"""
+        self.lines.appendleft(line)
+        self.ready.set()
+
+    async def readline(self) -> str:
+        """Waits for the next line typed
+
+        Cancelling this never loses a line, as it is only taken from the queue once it has been waited for.
+
+        Raises:
+            EOFError: If stdin has been closed
+        """
+        while not self.lines:
+            self.ready.clear()
+            await self.ready.wait()
+
+        line = self.lines.popleft()
+        if line is None:
+            # Left in the queue, so every later read ends the same way
+            self.lines.appendleft(None)
+            raise EOFError
+
+        return line
+
+    async def input(self, question: str, connection: Optional[Connection] = None) -> Union[str, pydantic.BaseModel]:
+        """Asks a question, then waits for the answer or the next message from the server, whichever comes first
+
+        Args:
+            connection: The server to listen to while waiting, or None to only wait for the answer.
+
+        Returns:
+            The line typed, or the message if the server sent one first. Anything typed
+            before the message arrived is kept for the next call.
+        """
+        print(question, end="", flush=True)
+        if connection is None:
+            return await self.readline()
+
+        typed = asyncio.ensure_future(self.readline())
+        received = asyncio.ensure_future(connection.recv())
+        try:
+            await asyncio.wait((typed, received), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Waited for until they have stopped, as websockets only allows one recv at a time.
+            # Cancelling a recv never loses the message it was waiting for.
+            pending = [task for task in (typed, received) if not task.done()]
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+        if received.cancelled():
+            return typed.result()
+
+        if not typed.cancelled() and typed.exception() is None:
+            self.unread(typed.result())
+
+        return received.result()
+
+    def close(self):
+        if self.watching:
+            self.loop.remove_reader(sys.stdin.fileno())
+            self.watching = False
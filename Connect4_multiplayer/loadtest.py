@@ -0,0 +1,417 @@
+"""Load tests the server with many headless bot players playing each other
+
+By default a server is started on a free port for the test, so its memory can
+be measured, or pass --uri to test a server that is already running.
+
+    python loadtest.py --players 2000 --games 3 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+from websockets.client import connect
+
+from client import ClientGrid
+from shared import *
+
+
+class BotPlayer:
+    """Plays random moves with the same game logic as `client.py`, but without any input or output"""
+
+    __slots__ = ("username", "partner", "encoding", "quick_match", "rng", "latencies", "waits", "moves")
+
+    username: str
+    # The username of the player who creates the room, None if this player creates it
+    partner: Optional[str]
+    encoding: Encoding
+    # If games are found with quick_match instead of rooms, ignoring `partner`
+    quick_match: bool
+    rng: random.Random
+
+    # Seconds from sending each move to it being applied
+    latencies: list[float]
+    # Seconds from connecting to GAME_START, for each game
+    waits: list[float]
+    moves: int
+
+    def __init__(
+        self, username: str, partner: Optional[str], encoding: Encoding, seed: int, quick_match: bool = False
+    ) -> None:
+        self.username = username
+        self.partner = partner
+        self.encoding = encoding
+        self.quick_match = quick_match
+        self.rng = random.Random(seed)
+        self.latencies = []
+        self.waits = []
+        self.moves = 0
+
+    async def login(self, websocket) -> tuple[Connection, CurrentRooms]:
+        await websocket.send(ClientServerMessage(
+            c = "login",
+            a = {"username": self.username, "encoding": self.encoding.value}
+        ).json())
+
+        first_response = await websocket.recv()
+        encoding = Encoding.BINARY if isinstance(first_response, bytes) else Encoding.JSON
+
+        current_rooms = decode_message(first_response)
+        assert isinstance(current_rooms, CurrentRooms)
+        return Connection(websocket, encoding), current_rooms
+
+    async def find_room(self, connection: Connection, current_rooms: CurrentRooms) -> int:
+        """Finds the room made by `self.partner`, by reading every page and then waiting for updates"""
+        requested_pages = 1
+        while True:
+            match current_rooms:
+                case CurrentRooms(rooms=rooms) | LobbyUpdate(added=rooms):
+                    for room_id, username in rooms.items():
+                        if username == self.partner:
+                            return room_id
+
+            if isinstance(current_rooms, CurrentRooms) and requested_pages < current_rooms.pages:
+                await connection.send(ClientServerMessage(c = "rooms", a = {"page": requested_pages}))
+                requested_pages += 1
+
+            try:
+                current_rooms = await asyncio.wait_for(connection.recv(), timeout=1)
+            except asyncio.TimeoutError:
+                # The room may have moved to a page already read, so start again
+                requested_pages = 1
+                await connection.send(ClientServerMessage(c = "rooms", a = {"page": 0}))
+                current_rooms = await connection.recv()
+
+    async def play_game(self, uri: str, redirected_room: Optional[int] = None):
+        start = time.perf_counter()
+        async with connect(uri, max_queue=None) as websocket:
+            connection, current_rooms = await self.login(websocket)
+
+            if self.quick_match:
+                # The side played is in GAME_START
+                client_player = Cell.EMPTY
+                await connection.send(ClientServerMessage(c = "quick_match", a = {}))
+            elif self.partner is None:
+                client_player = Cell.RED_PLAYER
+                await connection.send(ClientServerMessage(c = "create", a = {}))
+            else:
+                client_player = Cell.YELLOW_PLAYER
+                if redirected_room is None:
+                    room_id = await self.find_room(connection, current_rooms)
+                else:
+                    room_id = redirected_room
+
+                await connection.send(ClientServerMessage(c = "connect", a = {}, t = room_id))
+
+            response = await connection.recv()
+            while isinstance(response, (LobbyUpdate, CurrentRooms)):
+                response = await connection.recv()
+
+            if isinstance(response, Redirect):
+                # Running against a sharded server, so follow it like the real client
+                host = uri.rsplit(":", 1)[0]
+                return await self.play_game(f"{host}:{response.port}", response.t)
+
+            assert isinstance(response, GameStart)
+            self.waits.append(time.perf_counter() - start)
+            await self.play(connection, ClientGrid(response, client_player))
+
+    async def play(self, connection: Connection, grid: ClientGrid):
+        sent_at = None
+        while True:
+            if grid.current_player == grid.client_player and sent_at is None:
+                # Only play in columns with space, so no turns are skipped
+                column = self.rng.choice([c for c in range(grid.columns) if grid.inner[0][c] == Cell.EMPTY])
+
+                sent_at = time.perf_counter()
+                await connection.send(ClientServerMessage(c = "play_piece", a = {"column": column}))
+
+            update = await grid.wait_for_update(connection)
+            if isinstance(update, MoveApplied) and update.player == grid.client_player and sent_at is not None:
+                self.latencies.append(time.perf_counter() - sent_at)
+                self.moves += 1
+                sent_at = None
+
+            if isinstance(update, Forfeit) or update.game_end:
+                return
+
+
+class LoopLagMonitor:
+    """Measures how late a repeating timer fires, to spot an overloaded event loop"""
+
+    __slots__ = ("interval", "samples", "task")
+
+    interval: float
+    samples: list[float]
+    task: Optional[asyncio.Task[None]]
+
+    def __init__(self, interval: float = 0.1) -> None:
+        self.interval = interval
+        self.samples = []
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - expected))
+
+
+async def ping_server(uri: str, samples: list[float], interval: float = 0.1):
+    """Measures websocket ping round trips, which the server can only answer between other work on its loop"""
+    async with connect(uri) as websocket:
+        while True:
+            start = time.perf_counter()
+            await (await websocket.ping())
+            samples.append(time.perf_counter() - start)
+            await asyncio.sleep(interval)
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """Gets the resident memory of a process, only supported on Linux"""
+    try:
+        status = Path(f"/proc/{pid}/status").read_text()
+    except OSError:
+        return None
+
+    for line in status.splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) * 1024
+
+    return None
+
+async def sample_memory(pid: int, peak: list[int], interval: float = 0.25):
+    while True:
+        if (rss := rss_bytes(pid)) is not None:
+            peak[0] = max(peak[0], rss)
+
+        await asyncio.sleep(interval)
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    """Gets a percentile by the nearest rank, samples must already be sorted"""
+    if not samples:
+        return 0.0
+
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def summarise(samples: list[float]) -> dict[str, float]:
+    """Summarises seconds as milliseconds"""
+    samples = sorted(samples)
+    return {
+        "p50_ms": percentile(samples, 0.5) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": (samples[-1] if samples else 0.0) * 1000,
+        "mean_ms": (statistics.fmean(samples) if samples else 0.0) * 1000,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("localhost", 0))
+        return probe.getsockname()[1]
+
+async def wait_for_server(port: int, timeout: float = 10):
+    """Waits for a started server to accept connections, without opening a websocket it would need to handle"""
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("localhost", port)
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return
+
+
+async def run(
+    uri: str,
+    players: int,
+    games: int,
+    encoding: Encoding,
+    seed: int,
+    connect_limit: int,
+    server_pid: Optional[int] = None,
+    quick_match: bool = False,
+) -> dict[str, Any]:
+    """Runs every pair of players through `games` games and collects the results
+
+    Args:
+        uri: The websocket URI of the server.
+        players: The number of simulated players, half create rooms and half join them.
+        games: The number of games each pair of players plays, one after another.
+        encoding: The encoding each player asks for at login.
+        seed: Seeds the moves played, so runs can be repeated.
+        connect_limit: The most players to be connecting and logging in at once.
+        server_pid: The process to measure the memory of, if the server is local.
+        quick_match: If players are paired by the server's quick match queue, instead of
+            half creating rooms and the other half finding and joining them.
+    """
+    rooms = players // 2
+    bots: list[BotPlayer] = []
+    for pair in range(rooms):
+        creator = f"loadtest-{pair}"
+        bots.append(BotPlayer(creator, None, encoding, seed * players + 2 * pair, quick_match))
+        bots.append(BotPlayer(f"{creator}-joiner", creator, encoding, seed * players + 2 * pair + 1, quick_match))
+
+    connecting = asyncio.Semaphore(connect_limit)
+
+    async def play_pair(creator: BotPlayer, joiner: BotPlayer):
+        for _ in range(games):
+            async with connecting:
+                creating = asyncio.create_task(creator.play_game(uri))
+                # Give the room a moment to open, so the joiner usually finds it in the first page
+                await asyncio.sleep(0.01)
+
+            await asyncio.gather(creating, joiner.play_game(uri))
+
+    lag = LoopLagMonitor()
+    ping_samples: list[float] = []
+    peak_memory = [0]
+    baseline_memory = rss_bytes(server_pid) if server_pid is not None else None
+
+    background = [asyncio.create_task(ping_server(uri, ping_samples))]
+    if server_pid is not None:
+        background.append(asyncio.create_task(sample_memory(server_pid, peak_memory)))
+
+    lag.start()
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(play_pair(bots[i], bots[i + 1]) for i in range(0, len(bots), 2)), return_exceptions=True
+    )
+    seconds = time.perf_counter() - start
+    lag.stop()
+
+    for task in background:
+        task.cancel()
+
+    errors = [result for result in results if isinstance(result, BaseException)]
+    latencies = [latency for bot in bots for latency in bot.latencies]
+    waits = [wait for bot in bots for wait in bot.waits]
+    moves = sum(bot.moves for bot in bots)
+
+    report: dict[str, Any] = {
+        "players": len(bots),
+        "games": rooms * games,
+        "failed_pairs": len(errors),
+        "encoding": encoding.value,
+        "quick_match": quick_match,
+        "seed": seed,
+        "seconds": seconds,
+        "moves": moves,
+        "moves_per_second": moves / seconds if seconds else 0.0,
+        "move_latency": summarise(latencies),
+        "time_to_game": summarise(waits),
+        "server_ping": summarise(ping_samples),
+        "client_loop_lag": summarise(lag.samples),
+    }
+
+    if baseline_memory is not None and peak_memory[0]:
+        report["server_memory_bytes"] = peak_memory[0]
+        report["memory_per_room_bytes"] = (peak_memory[0] - baseline_memory) / max(rooms, 1)
+
+    if errors:
+        report["first_error"] = repr(errors[0])
+
+    return report
+
+def print_report(report: dict[str, Any]):
+    print(f"{report['games']} games by {report['players']} players in {report['seconds']:.2f}s", end="")
+    print(f", {report['failed_pairs']} pairs failed" if report["failed_pairs"] else "")
+    print(f"{report['moves']} moves, {report['moves_per_second']:,.0f} moves/s")
+
+    for name, title in (
+        ("move_latency", "Move round trip"),
+        ("time_to_game", "Time to game"),
+        ("server_ping", "Server ping (loop lag)"),
+        ("client_loop_lag", "Load tester loop lag"),
+    ):
+        summary = report[name]
+        print(f"{title}: p50 {summary['p50_ms']:.2f}ms, p99 {summary['p99_ms']:.2f}ms, max {summary['max_ms']:.2f}ms")
+
+    if "memory_per_room_bytes" in report:
+        print(
+            f"Server memory: {report['server_memory_bytes'] / 2**20:.1f} MiB peak, "
+            f"{report['memory_per_room_bytes'] / 1024:.1f} KiB per room"
+        )
+
+    if "first_error" in report:
+        print(f"First error: {report['first_error']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load tests the Connect 4 server")
+    parser.add_argument("--uri", default=None, help="A running server to test, instead of starting one")
+    parser.add_argument("--server-pid", type=int, default=None, help="The pid of the --uri server, to measure memory")
+    parser.add_argument("--shards", type=int, default=1, help="The number of shards for the started server")
+    parser.add_argument("--players", type=int, default=200)
+    parser.add_argument("--games", type=int, default=1, help="The number of games played by each pair of players")
+    parser.add_argument("--encoding", choices=[e.value for e in Encoding], default=Encoding.BINARY.value)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--connect-limit", type=int, default=200, help="The most players logging in at once")
+    parser.add_argument("--output", default=None, help="A file to write the results to as JSON")
+    parser.add_argument(
+        "--quick-match", action="store_true", help="Pair players with quick_match, instead of through rooms"
+    )
+    args = parser.parse_args()
+
+    server = None
+    uri = args.uri
+    server_pid = args.server_pid
+    if uri is None:
+        port = free_port()
+        server = subprocess.Popen(
+            # Bots move as fast as the server replies, so would spend most of the test rate limited.
+            # Their games are not worth keeping, so are not written to a game log in the working directory.
+            [
+                sys.executable, "server.py", "--port", str(port), "--shards", str(args.shards), "--rate-limit", "0",
+                "--no-game-log",
+            ],
+            cwd=Path(__file__).parent,
+            stdout=subprocess.DEVNULL,
+        )
+        uri = f"ws://localhost:{port}"
+        # Shards are separate processes, so only a single process server can be measured
+        server_pid = server.pid if args.shards == 1 else None
+
+    try:
+        if server is not None:
+            asyncio.run(wait_for_server(port))
+
+        report = asyncio.run(run(
+            uri,
+            args.players,
+            args.games,
+            Encoding(args.encoding),
+            args.seed,
+            args.connect_limit,
+            server_pid,
+            args.quick_match,
+        ))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print_report(report)
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=4)
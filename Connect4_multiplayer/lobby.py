@@ -0,0 +1,91 @@
+import asyncio
+import itertools
+import math
+from typing import Optional
+
+from shared import Connection, CurrentRooms, LobbyUpdate, send_to_all
+from validation import MeasuredEncoded
+
+# The number of rooms sent in each page of CURRENT_ROOMS
+PAGE_SIZE = 50
+
+
+def paginate(rooms: dict[int, str], page: int) -> CurrentRooms:
+    """Gets one page of `rooms`, clamping `page` to the pages that exist"""
+    pages = max(1, math.ceil(len(rooms) / PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+
+    start = page * PAGE_SIZE
+    return CurrentRooms(rooms=dict(itertools.islice(rooms.items(), start, start + PAGE_SIZE)), page=page, pages=pages)
+
+
+class Lobby:
+    """Pushes changes to the list of open rooms to every client in the lobby
+
+    Changes are collected until the end of the current event loop tick and then
+    sent together as one LOBBY_UPDATE, so a burst of rooms opening and closing
+    only costs each client a single message. A room that opens and closes
+    within the same tick is never sent at all.
+    """
+
+    __slots__ = ("waiting", "subscribers", "added", "removed", "flush_handle")
+
+    # room id = username of the player waiting in it, for every open room
+    waiting: dict[int, str]
+    subscribers: set[Connection]
+
+    # Changes since the last flush
+    added: dict[int, str]
+    removed: set[int]
+    flush_handle: Optional[asyncio.Handle]
+
+    def __init__(self) -> None:
+        self.waiting = {}
+        self.subscribers = set()
+        self.added = {}
+        self.removed = set()
+        self.flush_handle = None
+
+    def page(self, page: int) -> CurrentRooms:
+        return paginate(self.waiting, page)
+
+    def subscribe(self, connection: Connection):
+        self.subscribers.add(connection)
+
+    def unsubscribe(self, connection: Connection):
+        self.subscribers.discard(connection)
+
+    def room_added(self, room_id: int, username: str):
+        self.waiting[room_id] = username
+        self.added[room_id] = username
+        self.schedule_flush()
+
+    def room_removed(self, room_id: int):
+        self.waiting.pop(room_id, None)
+
+        # A room added this tick was never sent, so there is nothing to remove
+        if self.added.pop(room_id, None) is None:
+            self.removed.add(room_id)
+
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        """Sends the changes collected this tick to every subscriber"""
+        self.flush_handle = None
+        if not (self.added or self.removed) or not self.subscribers:
+            self.added = {}
+            self.removed = set()
+            return
+
+        # Removals are applied before additions, so a reused room id ends up added
+        update = LobbyUpdate(added=self.added, removed=sorted(self.removed))
+        self.added = {}
+        self.removed = set()
+
+        # Clients that have disconnected are unsubscribed by their own task, so
+        # their failed sends can be ignored here
+        asyncio.ensure_future(send_to_all(self.subscribers, MeasuredEncoded(update), return_exceptions=True))
@@ -0,0 +1,106 @@
+import asyncio
+import collections
+import zlib
+from typing import Generic, Optional, TypeVar
+
+from shared import Connection, Rules
+
+Game = TypeVar("Game")
+
+# Players are only matched with others whose rating is in the same band of this many points
+RATING_BAND = 200
+
+
+def match_key(rules: Rules, rating: Optional[int]) -> str:
+    """Gets the queue a player waits in, players are only matched with others in the same queue
+
+    Args:
+        rules: The rules the player wants to play by.
+        rating: The player's rating, or None to be matched with anyone else who left it out.
+    """
+    band = "any" if rating is None else str(rating // RATING_BAND)
+    return f"{rules.columns}x{rules.rows}/{rules.connect}/{band}"
+
+def key_owner(key: str, shards: list[int]) -> int:
+    """Picks the shard which matches players for a key, the same in every process
+
+    Every player with the same key has to be queued in the same process to be matched,
+    but different keys are spread over every shard.
+    """
+    return shards[zlib.crc32(key.encode()) % len(shards)]
+
+
+class Ticket(Generic[Game]):
+    """A player waiting for a quick match"""
+
+    __slots__ = ("connection", "username", "matched")
+
+    connection: Connection
+    username: str
+    # Given the game by the player who is matched with this one
+    matched: asyncio.Future[Game]
+
+    def __init__(self, connection: Connection, username: str) -> None:
+        self.connection = connection
+        self.username = username
+        self.matched = asyncio.get_running_loop().create_future()
+
+
+class MatchQueue(Generic[Game]):
+    """Pairs up players asking for a quick match, first come first served within each key
+
+    Each key has its own queue, ordered by when each player joined it. Matching
+    a player only looks at the front of their queue, and a player leaving is
+    removed by their ticket, so both are O(1) however many players are waiting.
+    """
+
+    __slots__ = ("queues", "waiting")
+
+    # key = the tickets waiting with that key, oldest first. Only the keys of the
+    # OrderedDict are used, as it can pop from the front and delete from anywhere.
+    queues: dict[str, collections.OrderedDict[Ticket[Game], None]]
+    # The number of tickets in every queue
+    waiting: int
+
+    def __init__(self) -> None:
+        self.queues = {}
+        self.waiting = 0
+
+    def __len__(self) -> int:
+        return self.waiting
+
+    def pair(self, key: str, ticket: Ticket[Game]) -> Optional[Ticket[Game]]:
+        """Matches a player with whoever has waited longest with the same key
+
+        Returns:
+            The ticket of the player to play against, or None if nobody was waiting,
+            in which case `ticket` is queued until someone else is matched with it.
+        """
+        if (queue := self.queues.get(key)) is not None:
+            partner, _ = queue.popitem(last=False)
+            if not queue:
+                del self.queues[key]
+
+            self.waiting -= 1
+            return partner
+
+        self.queues[key] = collections.OrderedDict({ticket: None})
+        self.waiting += 1
+        return None
+
+    def cancel(self, key: str, ticket: Ticket[Game]) -> bool:
+        """Removes a player who left before being matched
+
+        Returns:
+            If the ticket was still waiting, otherwise it has already been matched
+        """
+        queue = self.queues.get(key)
+        if queue is None or ticket not in queue:
+            return False
+
+        del queue[ticket]
+        if not queue:
+            del self.queues[key]
+
+        self.waiting -= 1
+        return True
@@ -0,0 +1,155 @@
+"""Counters, gauges and histograms for the server, in the Prometheus text format
+
+Served as plain text over HTTP with `serve_metrics`, or written to a file every
+few seconds with `dump_metrics`.
+"""
+
+import asyncio
+import bisect
+import contextlib
+import os
+import time
+from typing import Callable, Optional
+
+# Bucket upper bounds in seconds, from 50us to 1s
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0
+)
+
+
+class Histogram:
+    """Counts observations into fixed buckets, so recording one is just a binary search"""
+
+    __slots__ = ("buckets", "counts", "count", "total")
+
+    buckets: tuple[float, ...]
+    # The number of observations in each bucket, plus one more for those above every bucket
+    counts: list[int]
+    count: int
+    total: float
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def render(self, name: str) -> list[str]:
+        lines = [f"# TYPE {name} histogram"]
+
+        # Prometheus buckets are cumulative, counting everything at or below the bound
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.total}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class Metrics:
+    """Every metric for this process, each name is prefixed with `connect4_` when rendered"""
+
+    __slots__ = ("counters", "gauges", "histograms")
+
+    # Only ever go up, such as the total number of moves played
+    counters: dict[str, int]
+    # Read when rendered, so they are always current without being updated everywhere
+    gauges: dict[str, Callable[[], float]]
+    histograms: dict[str, Histogram]
+
+    def __init__(self) -> None:
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name: str, read: Callable[[], float]):
+        self.gauges[name] = read
+
+    def histogram(self, name: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        """Gets a histogram, creating it the first time. The buckets are only used when creating it."""
+        if (histogram := self.histograms.get(name)) is None:
+            histogram = self.histograms[name] = Histogram(buckets)
+
+        return histogram
+
+    def render(self) -> str:
+        lines = []
+        for name, value in self.counters.items():
+            lines += [f"# TYPE connect4_{name} counter", f"connect4_{name} {value}"]
+
+        for name, read in self.gauges.items():
+            lines += [f"# TYPE connect4_{name} gauge", f"connect4_{name} {read()}"]
+
+        for name, histogram in self.histograms.items():
+            lines += histogram.render(f"connect4_{name}")
+
+        return "\n".join(lines) + "\n"
+
+
+# Shared by everything in this process, so the hot paths do not need a reference passed in
+metrics = Metrics()
+
+
+async def monitor_loop_lag(interval: float = 0.1):
+    """Records how late a repeating timer fires, which is how long the event loop was blocked for"""
+    lag = metrics.histogram("loop_lag_seconds")
+    while True:
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        lag.observe(max(0.0, time.perf_counter() - expected))
+
+
+async def handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # Every request gets the metrics, so only the headers need reading
+    with contextlib.suppress(ConnectionError):
+        while (await reader.readline()).strip():
+            pass
+
+        body = metrics.render().encode()
+        writer.write(
+            b"HTTP/1.0 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+
+    writer.close()
+
+async def serve_metrics(port: int):
+    """Serves the metrics over plain HTTP, only to this machine"""
+    server = await asyncio.start_server(handle_scrape, "localhost", port)
+    async with server:
+        await server.serve_forever()
+
+async def dump_metrics(path: str, interval: float = 10.0):
+    """Writes the metrics to `path` every `interval` seconds"""
+    while True:
+        await asyncio.sleep(interval)
+
+        # Replaced in one go, so readers never see a half written file
+        with open(f"{path}.tmp", "w") as metrics_file:
+            metrics_file.write(metrics.render())
+
+        os.replace(f"{path}.tmp", path)
+
+def start_reporting(port: Optional[int] = None, path: Optional[str] = None) -> list[asyncio.Task[None]]:
+    """Starts measuring event loop lag, and serving or dumping the metrics if asked to"""
+    tasks = [asyncio.create_task(monitor_loop_lag())]
+    if port is not None:
+        tasks.append(asyncio.create_task(serve_metrics(port)))
+    if path is not None:
+        tasks.append(asyncio.create_task(dump_metrics(path)))
+
+    return tasks
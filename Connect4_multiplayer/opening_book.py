@@ -0,0 +1,169 @@
+import argparse
+import mmap
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Optional
+
+from typing_extensions import Self
+
+from ai import Searcher
+from bitboard import Bitboard
+
+BOOK_PATH = "opening_book.bin"
+
+# magic, rows, columns, number of records
+HEADER = struct.Struct("<4sBBI")
+MAGIC = b"C4BK"
+# position key, best column, score
+RECORD = struct.Struct("<Qbi")
+
+
+class OpeningBook:
+    """A read only opening book, looked up by binary search over a memory mapped file
+
+    The file is a header followed by fixed size records sorted by position key.
+    As the file is mapped rather than read, opening it is instant and every
+    process using the same book shares the same pages through the OS page cache.
+    """
+
+    __slots__ = ("file", "data", "rows", "columns", "count")
+
+    rows: int
+    columns: int
+    # The number of records in the book
+    count: int
+
+    def __init__(self, path: str) -> None:
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.rows, self.columns, self.count = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an opening book")
+
+    @classmethod
+    def open(cls, path: str = BOOK_PATH) -> Optional[Self]:
+        """Opens the book at `path`, or returns None if it has not been generated"""
+        try:
+            return cls(path)
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def lookup(self, key: int) -> Optional[tuple[int, int]]:
+        """Finds the best column and its score for a position key
+
+        Args:
+            key: The key of the position, from `Bitboard.key`.
+        """
+        low = 0
+        high = self.count - 1
+
+        while low <= high:
+            mid = (low + high) // 2
+            record_key, column, score = RECORD.unpack_from(self.data, HEADER.size + mid * RECORD.size)
+
+            if record_key == key:
+                return column, score
+
+            if record_key > key:
+                high = mid - 1
+            else:
+                low = mid + 1
+
+        return None
+
+    def lookup_board(self, board: Bitboard, player: int) -> Optional[tuple[int, int]]:
+        """Finds the best column and its score for `player` to move on `board`"""
+        if (board.rows, board.columns) != (self.rows, self.columns):
+            return None
+
+        return self.lookup(board.key(player))
+
+
+def positions_to_depth(columns: int, rows: int, depth: int) -> list[list[int]]:
+    """Finds the moves leading to every unfinished position up to `depth` moves deep
+
+    Positions reached by more than one order of moves are only included once.
+    """
+    found = {Bitboard(columns, rows).key(0): []}
+    frontier = [[]]
+
+    for _ in range(depth):
+        next_frontier = []
+        for moves in frontier:
+            for column in range(columns):
+                board = Bitboard(columns, rows)
+                for player, played in enumerate(moves + [column]):
+                    row = board.drop(played, player % 2)
+
+                if row is None or board.has_won_at(row, column, len(moves) % 2) or board.is_draw():
+                    continue
+
+                key = board.key(board.moves % 2)
+                if key not in found:
+                    found[key] = moves + [column]
+                    next_frontier.append(moves + [column])
+
+        frontier = next_frontier
+
+    return list(found.values())
+
+def search_position(moves: list[int], columns: int, rows: int, time_budget: float) -> tuple[int, int, int]:
+    """Searches one position for the book, run inside a worker process"""
+    board = Bitboard(columns, rows)
+    for player, column in enumerate(moves):
+        board.drop(column, player % 2)
+
+    player = board.moves % 2
+    result = Searcher(time_budget).best_move(board, player)
+    return board.key(player), result.column, result.score
+
+def generate(
+    path: str = BOOK_PATH,
+    depth: int = 4,
+    columns: int = 7,
+    rows: int = 6,
+    time_budget: float = 1.0,
+    workers: Optional[int] = None,
+) -> int:
+    """Searches every position up to `depth` moves deep and writes the results to a book
+
+    Args:
+        path: The file to write the book to.
+        depth: The number of moves into the game to generate the book for.
+        columns: The number of columns on the board.
+        rows: The number of rows on the board.
+        time_budget: The number of seconds to search each position for.
+        workers: The number of processes to search with, defaults to one per core.
+
+    Returns:
+        The number of positions written to the book
+    """
+    positions = positions_to_depth(columns, rows, depth)
+
+    with ProcessPoolExecutor(workers) as executor:
+        search = partial(search_position, columns=columns, rows=rows, time_budget=time_budget)
+        records = sorted(executor.map(search, positions, chunksize=16))
+
+    with open(path, "wb") as book_file:
+        book_file.write(HEADER.pack(MAGIC, rows, columns, len(records)))
+        book_file.write(b"".join(RECORD.pack(*record) for record in records))
+
+    return len(records)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates a Connect 4 opening book")
+    parser.add_argument("--depth", type=int, default=4, help="The number of moves into the game to cover")
+    parser.add_argument("--time", type=float, default=1.0, help="Seconds to search each position for")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default=BOOK_PATH)
+    args = parser.parse_args()
+
+    count = generate(args.output, args.depth, time_budget=args.time, workers=args.workers)
+    print(f"Wrote {count} positions to {args.output}")
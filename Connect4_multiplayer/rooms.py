@@ -0,0 +1,138 @@
+import asyncio
+import heapq
+import secrets
+from typing import Generic, Optional, TypeVar
+
+from lobby import Lobby
+
+Game = TypeVar("Game")
+
+
+class IdAllocator:
+    """Hands out room ids, reusing the lowest released id first
+
+    Released ids are kept in a min-heap, so finding one does not need a scan
+    over every room.
+    """
+
+    __slots__ = ("free_ids", "next_id")
+
+    # Ids that were used and have since been released
+    free_ids: list[int]
+    # The lowest id that has never been handed out
+    next_id: int
+
+    def __init__(self) -> None:
+        self.free_ids = []
+        self.next_id = 0
+
+    def allocate(self) -> int:
+        if self.free_ids:
+            return heapq.heappop(self.free_ids)
+
+        room_id = self.next_id
+        self.next_id += 1
+        return room_id
+
+    def release(self, room_id: int):
+        heapq.heappush(self.free_ids, room_id)
+
+
+class RoomRegistry(Generic[Game]):
+    """The rooms and running games owned by this server process, indexed by room id"""
+
+    __slots__ = ("waiters", "pending", "games")
+
+    # Set when a second player joins, waking up the player who created the room
+    waiters: dict[int, asyncio.Event]
+    # The game set up by the creator of each waiting room, with the rules they chose
+    pending: dict[int, Game]
+    games: dict[int, Game]
+
+    def __init__(self) -> None:
+        self.waiters = {}
+        self.pending = {}
+        self.games = {}
+
+    def create(self, room_id: int, game: Game) -> asyncio.Event:
+        """Opens a new room for `game`, returning the event set when someone joins"""
+        self.waiters[room_id] = waiter = asyncio.Event()
+        self.pending[room_id] = game
+        return waiter
+
+    def join(self, room_id: int) -> Optional[Game]:
+        """Starts the game in a waiting room and wakes up the player who created it
+
+        The creator only wakes up at the next await, so the joining player can be
+        added to the game before then.
+
+        Returns:
+            The game, or None if the room was taken or is not owned by this process
+        """
+        if (waiter := self.waiters.pop(room_id, None)) is None:
+            return None
+
+        self.games[room_id] = game = self.pending.pop(room_id)
+
+        waiter.set()
+        return game
+
+    def cancel(self, room_id: int) -> bool:
+        """Closes a room that nobody joined, such as when its creator disconnects
+
+        Returns:
+            If the room was still waiting, otherwise someone has already joined it
+        """
+        self.pending.pop(room_id, None)
+        return self.waiters.pop(room_id, None) is not None
+
+    def finish(self, room_id: int) -> Optional[Game]:
+        """Removes a finished game"""
+        return self.games.pop(room_id, None)
+
+
+class LocalDirectory:
+    """Allocates room ids and lists open rooms for a server running as a single process
+
+    `cluster.ShardDirectory` has the same methods, for when rooms are spread over
+    many processes.
+    """
+
+    __slots__ = ("lobby", "ids")
+
+    lobby: Lobby
+    ids: IdAllocator
+
+    def __init__(self, lobby: Lobby) -> None:
+        self.lobby = lobby
+        self.ids = IdAllocator()
+
+    async def open(self, username: str) -> int:
+        """Allocates an id for a new room and lists it in the lobby"""
+        room_id = self.ids.allocate()
+        self.lobby.room_added(room_id, username)
+        return room_id
+
+    def close(self, room_id: int):
+        """Removes a room from the lobby, once it has been joined or cancelled"""
+        self.lobby.room_removed(room_id)
+
+    def release(self, room_id: int):
+        """Frees a room id to be used again, once the room is closed and any game in it has finished"""
+        self.ids.release(room_id)
+
+    def owner_port(self, room_id: int) -> Optional[int]:
+        """Gets the port of the process which owns a room, or None if it is this process"""
+        return None
+
+    def new_token(self) -> str:
+        """Makes a session token for a player to resume their game with"""
+        return secrets.token_hex(16)
+
+    def session_port(self, token: str) -> Optional[int]:
+        """Gets the port of the process which issued a token, or None if it is this process"""
+        return None
+
+    def match_port(self, key: str) -> Optional[int]:
+        """Gets the port of the process which matches players with a quick match key, or None if it is this process"""
+        return None
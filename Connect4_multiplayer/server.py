@@ -1,34 +1,142 @@
+import argparse
 import asyncio
 import contextlib
-from operator import add, sub
-from typing import Awaitable, Callable, Generator, Iterable
+import multiprocessing
+import signal
+import time
+from pathlib import Path
+from typing import Awaitable, Optional
 
+import pydantic
+
+from websockets.exceptions import ConnectionClosed
 from websockets.server import WebSocketServerProtocol, serve
 
+from ai import Searcher
+from bitboard import Bitboard
+from cluster import ShardDirectory, run_coordinator
+from gamelog import GAME_LOG_PATH, GameLog, GameRecord, Result
+from lobby import Lobby, paginate
+from matchmaking import MatchQueue, Ticket, match_key
+from metrics import metrics, start_reporting
+from opening_book import OpeningBook
+from rooms import LocalDirectory, RoomRegistry
+from spectators import Audience, Spectator
 from shared import *
+from validation import (
+    MAX_MESSAGE_SIZE, MESSAGE_RATE, ClientConnection, InvalidMessage, MeasuredEncoded, int_argument, parse_login,
+    room_target,
+)
+
+# Seconds a player has to reconnect after their connection drops, before they forfeit
+RECONNECT_GRACE = 30.0
+# Seconds a connected player has to make a move, so games that are left open do not run forever
+TURN_TIMEOUT = 300.0
+# The bot searches for about a second each move, which would overflow the default buckets
+SEARCH_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.25, 1.5, 2.0, 5.0)
+# Every depth on a standard 6x7 board, deeper searches on bigger boards are counted above the last bucket
+SEARCH_DEPTH_BUCKETS = tuple(float(depth) for depth in range(1, 43))
 
 
 class ServerGrid:
-    red_player: WebSocketServerProtocol
-    yellow_player: WebSocketServerProtocol
+    red_player: ClientConnection
+    # None if yellow is played by the bot, or before anyone has joined the room
+    yellow_player: Optional[ClientConnection]
 
-    inner: list[list[Cell]]
+    # The player controlled by the server, if any
+    bot: Optional[Cell]
+    searcher: Optional[Searcher]
+
+    board: Bitboard
+    # Cache of `inner`, cleared whenever a piece is added
+    _inner: list[list[Cell]] | None
 
     rows: int
     columns: int
+    # The number of pieces in a row needed to win
+    connect: int
     current_player: Cell
     has_finished: asyncio.Event
 
-    def __init__(self, yellow_player: WebSocketServerProtocol):
-        self.rows = 6
-        self.columns = 7
+    # The number of turns taken, sent with every update so clients can spot missed moves
+    seq: int
+    game_end: bool
+    draw: bool
+    # Moves sent by either player, as (player, column), read by `play`. A column of
+    # None is sent when a player disconnects or reconnects, to recheck the turn's deadline
+    moves: asyncio.Queue[tuple[Cell, Optional[int]]]
+    # Every MOVE_APPLIED sent, `history[seq - 1]` being the move with that seq
+    history: list[MoveApplied]
+
+    # Session tokens for each player, to resume the game with after reconnecting
+    tokens: dict[Cell, str]
+    readers: dict[Cell, asyncio.Task[None]]
+    # The event loop time each disconnected player's connection dropped
+    disconnected_at: dict[Cell, float]
+    turn_started: float
+
+    usernames: dict[Cell, str]
+    # The player who forfeited, if the game ended that way
+    forfeited: Optional[Cell]
+    audience: Audience
+
+    def __init__(
+        self,
+        yellow_player: Optional[ClientConnection],
+        bot: Optional[Cell] = None,
+        usernames: Optional[dict[Cell, str]] = None,
+        rules: Rules = Rules(),
+    ):
+        # The search and opening book both only know standard Connect 4
+        assert bot is None or rules.connect == 4
+
+        self.rows, self.columns, self.connect = rules
         self.yellow_player = yellow_player
+        self.bot = bot
+        self.searcher = None if bot is None else Searcher(time_budget=1.0, table_size=1 << 16)
         self.has_finished = asyncio.Event()
         self.current_player = Cell.RED_PLAYER
-        self.inner = [[Cell.EMPTY for _ in range(self.columns)] for _ in range(self.rows)]
-
-
-    def get_connection(self, cell: Cell) -> WebSocketServerProtocol:
+        self.board = Bitboard(self.columns, self.rows, self.connect)
+        self._inner = None
+        self.seq = 0
+        self.game_end = False
+        self.draw = False
+        self.moves = asyncio.Queue()
+        self.history = []
+        self.tokens = {}
+        self.readers = {}
+        self.disconnected_at = {}
+        self.turn_started = 0.0
+        self.usernames = usernames or {}
+        self.forfeited = None
+        self.audience = Audience()
+
+    @property
+    def title(self) -> str:
+        """Shown in the list of running games, such as `red vs yellow`"""
+        red = self.usernames.get(Cell.RED_PLAYER, "?")
+        yellow = self.usernames.get(Cell.YELLOW_PLAYER, "?")
+        return f"{red} vs {yellow}"
+
+    def game_start(self, player: Optional[Cell] = None) -> GameStart:
+        """Builds the GAME_START for one of the players, with their token, or for a spectator if None"""
+        return GameStart(
+            rows=self.rows,
+            columns=self.columns,
+            connect=self.connect,
+            token=None if player is None else self.tokens.get(player),
+            player=player,
+        )
+
+    @property
+    def inner(self) -> list[list[Cell]]:
+        """The board as a 2D list, built from `self.board` on first access"""
+        if self._inner is None:
+            self._inner = self.board.to_rows((Cell.EMPTY, Cell.RED_PLAYER, Cell.YELLOW_PLAYER))
+
+        return self._inner
+
+    def get_connection(self, cell: Cell) -> ClientConnection:
         assert cell != Cell.EMPTY
         match cell:
             case Cell.RED_PLAYER:
@@ -36,6 +144,13 @@ class ServerGrid:
             case Cell.YELLOW_PLAYER:
                 return self.yellow_player
 
+    def set_connection(self, cell: Cell, connection: ClientConnection):
+        match cell:
+            case Cell.RED_PLAYER:
+                self.red_player = connection
+            case Cell.YELLOW_PLAYER:
+                self.yellow_player = connection
+
     def swap_current_player(self):
         assert self.current_player != Cell.EMPTY
 
@@ -45,178 +160,685 @@ class ServerGrid:
             case Cell.YELLOW_PLAYER:
                 self.current_player = Cell.RED_PLAYER
 
-    def check_neighbours(self, iterable: Iterable[Cell]):
-        """Checks for 4 consecutive Cells of self.current_player
+    def player_index(self) -> int:
+        """Gets the index of `self.current_player` in `self.board`"""
+        assert self.current_player != Cell.EMPTY
+        return self.current_player.value - 1
 
-        Args:
-            iterable: The iterable to find consecutive cells in.
-        """
+    def add_piece(self, column_idx: int) -> Optional[int]:
+        """Adds a piece to the Grid
 
-        same_count = 0
-        for cell in iterable:
-            if cell != Cell.EMPTY and cell == self.current_player:
-                same_count += 1
-                if same_count == 4:
-                    return True
-            else:
-                same_count = 0
+        Args:
+            column_idx: The index of the column to add the piece to.
 
-        return False
+        Returns:
+            The index of the row in `inner` the piece landed on, or None if the column was full
+        """
+        row = self.board.drop(column_idx, self.player_index())
+        if row is None:
+            return None
 
-    def diagnoal_iter(self, x: int, y: int, y_op: Callable[[int, int], int]) -> Generator[Cell, None, None]:
-        """A generator to loop over `self.inner` diagonally
+        self._inner = None
+        return self.rows - 1 - row
 
-        This is performed by taking `x` and `y` from the current position on the board
-        and allows me to continue using check_neighbours for the actual checking of
-        "are there 4 matching cells".
+    def check_win_condition(self, last_move: Optional[tuple[int, int]] = None) -> bool:
+        """Checks if `self.current_player` has won
 
         Args:
-            x: The x position of the starting Cell.
-            y: The y position of the starting Cell.
-            y_op: The operation to perform on `y`, either `add` or `sub` for up right or down right matches.
+            last_move: The row and column returned from the last `add_piece`, if given
+                only the lines through this cell are checked instead of the whole board.
         """
+        if last_move is None:
+            return self.board.has_won(self.player_index())
 
-        i = 0
-        while True:
-            try:
-                yield self.inner[y_op(y, i)][x + i]
-            except IndexError:
-                # Went off the board, no more Cells
-                return
+        row, column = last_move
+        return self.board.has_won_at(self.rows - 1 - row, column, self.player_index())
 
-            i += 1
+    def key(self) -> int:
+        """A 64 bit Zobrist hash of the position, updated with every piece added"""
+        return self.board.zobrist
 
+    def is_column_full(self, column_idx: int) -> bool:
+        return self.board.is_full(column_idx)
 
-    def add_piece(self, column_idx: int) -> bool:
-        """Adds a piece to the Grid
+    def is_draw(self) -> bool:
+        """Checks if the board is full, this should only be checked after `check_win_condition`"""
+        return self.board.is_draw()
 
-        Args:
-            column_idx: The index of the column to add the piece to.
-            kind: The type of Cell to add, must not be EMPTY
 
-        Returns:
-            If piece addition was successful
-        """
-        assert self.current_player != Cell.EMPTY
+    def broadcast(self, message: pydantic.BaseModel) -> Awaitable[list[Any]]:
+        """Sends a message to both players and queues it for every spectator, encoding it only once"""
+        encoded = MeasuredEncoded(message)
+        self.audience.publish(encoded, self.board_update)
+        # A player who has disconnected will be caught up if they reconnect, so failed sends are ignored
+        players = (c for c in (self.yellow_player, self.red_player) if c is not None)
+        return send_to_all(players, encoded, return_exceptions=True)
 
-        for row_idx in range(self.rows - 1, -1, -1):
-            if self.inner[row_idx][column_idx] == Cell.EMPTY:
-                self.inner[row_idx][column_idx] = self.current_player
-                return True
+    def spectate(self, connection: Connection) -> Spectator:
+        """Adds a spectator, who is sent the game so far and then every move"""
+        start = [MeasuredEncoded(self.game_start()), MeasuredEncoded(self.board_update())]
+        return self.audience.add(connection, start)
 
-        return False
+    def board_update(self) -> BoardUpdate:
+        """Builds a full copy of the board, for clients that have fallen out of sync"""
+        return BoardUpdate(board=self.inner, game_end=self.game_end, draw=self.draw, seq=self.seq)
 
-    def check_win_condition(self) -> bool:
-        assert self.current_player != Cell.EMPTY
+    async def read_messages(self, player: Cell):
+        """Reads every message from a player while the game is running
 
-        # Check horizontal
-        if any(map(self.check_neighbours, self.inner)):
-            return True
+        This runs for both players at once, so a resync can be answered even when
+        it is not that player's turn.
+        """
+        connection = self.get_connection(player)
+        cancelled = False
+        try:
+            with contextlib.suppress(ConnectionClosed):
+                async for message in connection:
+                    match message.c:
+                        case "resync":
+                            await connection.send(self.board_update())
+                        case "play_piece":
+                            try:
+                                column = int_argument(message, "column")
+                            except InvalidMessage as error:
+                                await connection.reject(str(error))
+                                continue
+
+                            # Rejected straight away, so the queue only ever holds moves from the current player
+                            if player != self.current_player or self.game_end:
+                                await connection.reject("It is not your turn")
+                            else:
+                                self.moves.put_nowait((player, column))
+                        case _:
+                            await connection.reject(f"Unexpected command {message.c} during a game")
+        except asyncio.CancelledError:
+            # Cancelled when the player reconnects, with a new reader taking over, or once the game is over
+            cancelled = True
+            raise
+        finally:
+            # Anything else stopping the reader, even a bug, counts as a drop, so the game is never
+            # left waiting for moves that nobody is reading
+            if not cancelled:
+                self.disconnected_at[player] = asyncio.get_running_loop().time()
+                self.moves.put_nowait((player, None))
+
+    async def resume(self, player: Cell, connection: ClientConnection, seq: int):
+        """Swaps in a player's new connection, catching them up on every move after `seq`"""
+        await connection.send(self.game_start(player))
+
+        # Keep going until caught up, as moves can be played while sending
+        while seq < len(self.history):
+            await connection.send(self.history[seq])
+            seq += 1
+
+        if self.game_end:
+            return
+
+        # No awaits from here, so no move can be sent to the old connection instead
+        if (reader := self.readers.get(player)) is not None:
+            reader.cancel()
+
+        old_connection = self.get_connection(player)
+        asyncio.ensure_future(old_connection.websocket.close())
+
+        self.set_connection(player, connection)
+        self.disconnected_at.pop(player, None)
+        self.readers[player] = asyncio.create_task(self.read_messages(player))
+        self.moves.put_nowait((player, None))
+
+    def turn_deadline(self) -> float:
+        """Gets the event loop time the current player forfeits at, if they have not moved"""
+        deadline = self.turn_started + TURN_TIMEOUT
+        if (dropped := self.disconnected_at.get(self.current_player)) is not None:
+            deadline = min(deadline, dropped + RECONNECT_GRACE)
+
+        return deadline
+
+    async def next_move(self) -> Optional[int]:
+        """Waits for the current player to send a move that can be played
+
+        Moves sent out of turn are ignored, and moves off the board or in a full
+        column are rejected so the player can choose again.
+
+        Returns:
+            The column played, or None if the player ran out of time or did not reconnect in time
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                player, column = await asyncio.wait_for(self.moves.get(), max(0, self.turn_deadline() - loop.time()))
+            except asyncio.TimeoutError:
+                return None
 
-        # Check vertical
-        for column_idx in range(self.columns):
-            if self.check_neighbours((row[column_idx] for row in self.inner)):
-                return True
+            if player != self.current_player or column is None:
+                continue
 
-        # Check diagonal
-        for (y, row) in enumerate(self.inner):
-            for (x, cell) in enumerate(row):
-                if cell == Cell.EMPTY:
-                    continue
+            if not 0 <= column < self.columns:
+                reason = f"Column {column + 1} is not on the board"
+            elif self.is_column_full(column):
+                reason = f"Column {column + 1} is full"
+            else:
+                return column
 
-                if self.check_neighbours(self.diagnoal_iter(x, y, add)):
-                    return True
+            # Failing to send is fine, the player will forfeit unless they reconnect
+            with contextlib.suppress(ConnectionClosed):
+                await self.get_connection(player).reject(reason)
 
-                if self.check_neighbours(self.diagnoal_iter(x, y, sub)):
-                    return True
+    async def bot_move(self) -> int:
+        """Searches for the bot's move in a thread, to keep the event loop free for other games"""
+        assert self.searcher is not None
 
-        return False
+        if opening_book is not None and (entry := opening_book.lookup_board(self.board, self.player_index())):
+            column, _ = entry
+            metrics.increment("bot_book_moves_total")
+            return column
 
+        result = await asyncio.to_thread(self.searcher.best_move, self.board, self.player_index())
 
-    def broadcast(self, message: str) -> Awaitable[list[Any]]:
-        return asyncio.gather(*(
-            c.send(message) for c in (self.yellow_player, self.red_player)
-        ))
+        # Nodes per second is the rate of bot_search_nodes_total over the rate of bot_search_seconds_sum
+        metrics.increment("bot_search_nodes_total", result.nodes)
+        metrics.histogram("bot_search_seconds", SEARCH_SECONDS_BUCKETS).observe(result.seconds)
+        metrics.histogram("bot_search_depth", SEARCH_DEPTH_BUCKETS).observe(result.depth)
+        return result.column
 
-    async def play(self, red_player: WebSocketServerProtocol):
+    async def play(self, red_player: ClientConnection):
         self.red_player = red_player
 
-        await self.broadcast(GameStart(rows=self.rows, columns=self.columns).json())
+        try:
+            # Sent separately, as each player has their own token
+            players = [player for player in (Cell.RED_PLAYER, Cell.YELLOW_PLAYER) if player != self.bot]
+            await asyncio.gather(*(
+                self.get_connection(player).send(self.game_start(player)) for player in players
+            ), return_exceptions=True)
+
+            for player in players:
+                self.readers[player] = asyncio.create_task(self.read_messages(player))
+
+            while True:
+                self.turn_started = asyncio.get_running_loop().time()
+                if self.current_player == self.bot:
+                    column = await self.bot_move()
+                else:
+                    column = await self.next_move()
+
+                if column is None:
+                    self.game_end = True
+                    self.forfeited = self.current_player
+                    metrics.increment("forfeits_total")
+                    await self.broadcast(Forfeit(player=self.current_player, seq=self.seq))
+                    break
+
+                # Timed from here to the end of the broadcast, which is the work done by the server for each move
+                start = time.perf_counter()
+
+                player = self.current_player
+                row = self.add_piece(column)
+                # `next_move` only returns columns with space left
+                assert row is not None
+                won = self.check_win_condition((row, column))
+                self.draw = not won and self.is_draw()
+                self.game_end = won or self.draw
+
+                self.seq += 1
+                self.swap_current_player()
+
+                move = MoveApplied(
+                    column=column, row=row, player=player, seq=self.seq, game_end=self.game_end, draw=self.draw
+                )
+                self.history.append(move)
+                await self.broadcast(move)
+
+                metrics.histogram("move_seconds").observe(time.perf_counter() - start)
+                metrics.increment("moves_total")
+
+                if self.game_end:
+                    break
+        finally:
+            # Also run if anything above fails, so nothing is left waiting on a game that will never finish
+            self.game_end = True
+            for reader in self.readers.values():
+                reader.cancel()
+
+            self.audience.close(self.board_update())
+            self.has_finished.set()
+
+    def record(self, room_id: Optional[int]) -> GameRecord:
+        """Summarises the finished game for the game log"""
+        if self.forfeited is not None:
+            result = Result.RED_FORFEIT if self.forfeited == Cell.RED_PLAYER else Result.YELLOW_FORFEIT
+        elif self.draw:
+            result = Result.DRAW
+        else:
+            # The last move played is the winning one
+            result = Result.RED_WIN if self.history[-1].player == Cell.RED_PLAYER else Result.YELLOW_WIN
+
+        return GameRecord(
+            room_id=room_id,
+            red=self.usernames.get(Cell.RED_PLAYER, ""),
+            yellow=self.usernames.get(Cell.YELLOW_PLAYER, ""),
+            rows=self.rows,
+            columns=self.columns,
+            connect=self.connect,
+            moves=[move.column for move in self.history],
+            result=result,
+            bot=self.bot,
+            finished_at=time.time(),
+        )
 
-        while True:
-            connection = self.get_connection(self.current_player)
-            play_piece = ClientServerMessage.parse_raw(await connection.recv())
+class Server:
+    rooms: RoomRegistry[ServerGrid]
+    # Players waiting for a quick match, who are not in any room
+    match_queue: MatchQueue[ServerGrid]
+    lobby: Lobby
+    # Either a `LocalDirectory` or a `cluster.ShardDirectory`
+    directory: LocalDirectory | ShardDirectory
+
+    connections: int
+    # Including games against the bot, which have no room
+    running_games: int
+    # Session token = the game and player it resumes, for every running game
+    sessions: dict[str, tuple[ServerGrid, Cell]]
+    # Where finished games are recorded, if anywhere
+    game_log: Optional[GameLog]
+    # The average number of messages per second each client can send, 0 for no limit
+    message_rate: float
+
+    def __init__(
+        self,
+        directory: Optional[LocalDirectory | ShardDirectory] = None,
+        game_log: Optional[GameLog] = None,
+        message_rate: float = MESSAGE_RATE,
+    ):
+        self.rooms = RoomRegistry()
+        self.match_queue = MatchQueue()
+        self.game_log = game_log
+        self.message_rate = message_rate
+        if directory is None:
+            self.lobby = Lobby()
+            self.directory = LocalDirectory(self.lobby)
+        else:
+            self.lobby = directory.lobby
+            self.directory = directory
+
+        self.connections = 0
+        self.running_games = 0
+        self.sessions = {}
+
+        metrics.gauge("active_connections", lambda: self.connections)
+        metrics.gauge("open_rooms", lambda: len(self.rooms.waiters))
+        metrics.gauge("quick_match_waiting", lambda: len(self.match_queue))
+        metrics.gauge("running_games", lambda: self.running_games)
+        metrics.gauge("spectators", lambda: sum(len(game.audience) for game in self.rooms.games.values()))
+
+    async def new_client(self, websocket: WebSocketServerProtocol):
+        self.connections += 1
+        metrics.increment("connections_total")
+        try:
+            # Leaving at any point is normal, and is handled by whatever was waiting on the client
+            with contextlib.suppress(ConnectionClosed):
+                await self.handle_client(websocket)
+        finally:
+            self.connections -= 1
+
+    async def play_game(self, game: ServerGrid, red_player: ClientConnection, room_id: Optional[int] = None):
+        for player in (Cell.RED_PLAYER, Cell.YELLOW_PLAYER):
+            if player != game.bot:
+                game.tokens[player] = token = self.directory.new_token()
+                self.sessions[token] = (game, player)
+
+        self.running_games += 1
+        metrics.increment("games_started_total")
+        try:
+            await game.play(red_player)
+        finally:
+            self.running_games -= 1
+            for token in game.tokens.values():
+                self.sessions.pop(token, None)
+
+        if self.game_log is not None:
+            self.game_log.append(game.record(room_id))
+
+    async def resume_session(self, connection: ClientConnection, token: str, seq: int) -> bool:
+        """Reconnects a player to the game a session token is for
 
-            assert play_piece.c == "play_piece"
-            column: int = play_piece.a["column"]
-            self.add_piece(column)
-        
-            
-            game_end = self.check_win_condition()
-            self.swap_current_player()
+        Returns:
+            If the session was resumed, otherwise the game has finished and the client is put in the lobby
+        """
+        if (session := self.sessions.get(token)) is not None:
+            game, player = session
 
-            await self.broadcast(BoardUpdate(board=self.inner, game_end=game_end).json())
-            if game_end:
-                break
+            metrics.increment("resumes_total")
+            await game.resume(player, connection, seq)
+            await game.has_finished.wait()
+            return True
 
-        self.has_finished.set()
+        if (port := self.directory.session_port(token)) is not None:
+            await connection.send(Redirect(port=port, t=None))
+            return True
 
-class Server:
-    room_waiters: dict[int, asyncio.Event]
-    current_games: dict[int, ServerGrid]
-    waiting_rooms: dict[int, str]
-
-    def __init__(self):
-        self.room_waiters = {}
-        self.waiting_rooms = {}
-        self.current_games = {}
-
-    def next_id(self):
-        """Finds the next free ID to use for waiting_rooms"""
-        return next((
-            index
-            for index, id in enumerate(self.waiting_rooms.keys())
-            if index != id
-        ), 0)
-
-    async def new_client(self, connection: WebSocketServerProtocol):
-        login_message = ClientServerMessage.parse_raw(await connection.recv())
-        username = login_message.a["username"]
-        assert login_message.c == "login"
+        return False
 
-        while True:
-            await connection.send(CurrentRooms(rooms=self.waiting_rooms).json())
-            create_or_connect = ClientServerMessage.parse_raw(await connection.recv())
+    async def handle_client(self, websocket: WebSocketServerProtocol):
+        # The login is always JSON, as the encoding has not been chosen yet
+        try:
+            login_message = parse_login(await websocket.recv())
+        except InvalidMessage as error:
+            await websocket.send(Error(error=str(error)).json())
+            return
 
-            if create_or_connect.c == "create":
-                room_id = self.next_id()
-                self.waiting_rooms[room_id] = username
-                self.room_waiters[room_id] = asyncio.Event()
+        username = login_message.a["username"]
+        try:
+            encoding = Encoding(login_message.a.get("encoding", Encoding.JSON.value))
+        except ValueError:
+            # Unknown encodings fall back to JSON, which every client understands
+            encoding = Encoding.JSON
+
+        connection = ClientConnection(websocket, encoding, self.message_rate)
+
+        token = login_message.a.get("token")
+        if token and await self.resume_session(connection, token, login_message.a.get("seq", 0)):
+            return
+
+        # Only clients choosing a room need to hear about rooms opening and closing
+        self.lobby.subscribe(connection)
+        try:
+            command = await self.choose_room(connection, username)
+        finally:
+            self.lobby.unsubscribe(connection)
+
+        if command is None:
+            # Redirected to the process which owns the room, or matches the player
+            return
+        elif command.c == "quick_match":
+            await self.quick_match(connection, username, command)
+        elif command.c == "create" and command.a.get("bot"):
+            # Bot games start straight away, without a room
+            usernames = {Cell.RED_PLAYER: username, Cell.YELLOW_PLAYER: "Computer"}
+            await self.play_game(ServerGrid(yellow_player=None, bot=Cell.YELLOW_PLAYER, usernames=usernames), connection)
+        elif command.c == "create":
+            rules = Rules.from_arguments(command.a)
+            game = ServerGrid(yellow_player=None, usernames={Cell.RED_PLAYER: username}, rules=rules)
+
+            # Shown in the lobby, so players know what they are joining
+            label = username if rules == Rules() else f"{username} ({rules})"
+            room_id = await self.directory.open(label)
+            waiter = self.rooms.create(room_id, game)
+
+            # Wait for a different user to connect and setup a game, or for this one to leave
+            joined = asyncio.create_task(waiter.wait())
+            left = asyncio.create_task(websocket.wait_closed())
+            try:
+                await asyncio.wait((joined, left), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                joined.cancel()
+                left.cancel()
 
-                # Wait for a different user to connect and setup a game
-                await self.room_waiters[room_id].wait()
-                await self.current_games[room_id].play(connection)
-            else: # "connect"
-                room_id = create_or_connect.t
-                assert room_id is not None
+                if not waiter.is_set() and self.rooms.cancel(room_id):
+                    self.directory.close(room_id)
+                    self.directory.release(room_id)
 
-                if (waiter := self.room_waiters.pop(room_id, None)) is None:
-                    continue
+            if not waiter.is_set():
+                return
 
-                del self.waiting_rooms[room_id]
-                self.current_games[room_id] = ServerGrid(yellow_player=connection)
+            try:
+                await self.play_game(self.rooms.games[room_id], connection, room_id)
+            finally:
+                self.rooms.finish(room_id)
+                self.directory.release(room_id)
+        elif command.c == "spectate":
+            assert command.t is not None
 
-                # Wake up the "create" task and wait until the game finishes
-                waiter.set()
-                await self.current_games[room_id].has_finished.wait()
+            # Checked by `choose_room` with no await since, so the game is still running
+            spectator = self.rooms.games[command.t].spectate(connection)
+            await spectator.task
+        else: # "connect", and already joined by `choose_room`
+            assert command.t is not None
 
-            break
+            # The "create" task has been woken up, so wait until the game finishes
+            await self.rooms.games[command.t].has_finished.wait()
 
-    async def serve(self):
-        async with serve(self.new_client, port=4000):
-            with contextlib.suppress(KeyboardInterrupt):
-                await asyncio.Future()
+    async def choose_room(self, connection: ClientConnection, username: str) -> Optional[ClientServerMessage]:
+        """Sends pages of open rooms until the client creates a room, joins one or spectates a game
 
-server = Server()
+        Returns:
+            The "create", "connect" or "spectate" message, if it is a "connect" the room has been joined.
+            None if the room is owned by another process and the client has been redirected to it.
+        """
+        await connection.send(self.lobby.page(0))
 
-asyncio.run(Server().serve())
+        while True:
+            message = await connection.recv()
+            try:
+                match message.c:
+                    case "rooms":
+                        await connection.send(self.lobby.page(int_argument(message, "page", 0)))
+                    case "games":
+                        await connection.send(self.games_page(int_argument(message, "page", 0)))
+                    case "create":
+                        # Checked here, so nothing is set up for a game with impossible rules
+                        try:
+                            rules = Rules.from_arguments(message.a)
+                        except ValueError as error:
+                            raise InvalidMessage(str(error)) from None
+
+                        if rules != Rules() and message.a.get("bot"):
+                            raise InvalidMessage("The bot only plays standard Connect 4")
+
+                        return message
+                    case "quick_match":
+                        try:
+                            key = match_key(Rules.from_arguments(message.a), self.rating(message))
+                        except ValueError as error:
+                            raise InvalidMessage(str(error)) from None
+
+                        if (port := self.directory.match_port(key)) is not None:
+                            await connection.send(Redirect(port=port, t=None))
+                            return None
+
+                        return message
+                    case "spectate":
+                        game = self.rooms.games.get(room_target(message))
+                        if game is not None and not game.game_end:
+                            return message
+
+                        # The game has finished, so send the first page again to show what is running
+                        await connection.send(self.games_page(0))
+                    case "connect":
+                        room_id = room_target(message)
+
+                        if (game := self.rooms.join(room_id)) is not None:
+                            game.set_connection(Cell.YELLOW_PLAYER, connection)
+                            game.usernames[Cell.YELLOW_PLAYER] = username
+
+                            self.directory.close(room_id)
+                            return message
+
+                        if (port := self.directory.owner_port(room_id)) is not None:
+                            await connection.send(Redirect(port=port, t=room_id))
+                            return None
+
+                        # The room is gone, so send the first page again to show what is open
+                        await connection.send(self.lobby.page(0))
+                    case _:
+                        raise InvalidMessage(f"Unexpected command {message.c} in the lobby")
+            except InvalidMessage as error:
+                await connection.reject(str(error))
+
+    @staticmethod
+    def rating(message: ClientServerMessage) -> Optional[int]:
+        """Gets the rating a player asked to be matched by, if any"""
+        return int_argument(message, "rating") if "rating" in message.a else None
+
+    async def quick_match(self, connection: ClientConnection, username: str, command: ClientServerMessage):
+        """Plays against the player who has waited longest for the same rules and rating, or waits for one
+
+        The second player of each pair builds the game and plays it straight away, so
+        no room is opened and nobody else in the lobby hears about it.
+        """
+        rules = Rules.from_arguments(command.a)
+        key = match_key(rules, self.rating(command))
+        ticket: Ticket[ServerGrid] = Ticket(connection, username)
+
+        if (partner := self.match_queue.pair(key, ticket)) is not None:
+            metrics.increment("quick_matches_total")
+
+            # Whoever waited plays first, as the room creator would
+            usernames = {Cell.RED_PLAYER: partner.username, Cell.YELLOW_PLAYER: username}
+            game = ServerGrid(yellow_player=connection, usernames=usernames, rules=rules)
+            partner.matched.set_result(game)
+
+            await self.play_game(game, partner.connection)
+            return
+
+        # Wait for someone else to be matched with this player, or for this one to leave
+        left = asyncio.create_task(connection.websocket.wait_closed())
+        try:
+            await asyncio.wait((ticket.matched, left), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            left.cancel()
+            if self.match_queue.cancel(key, ticket):
+                ticket.matched.cancel()
+
+        if not ticket.matched.cancelled():
+            # The other player's task is running the game
+            await ticket.matched.result().has_finished.wait()
+
+    def games_page(self, page: int) -> CurrentRooms:
+        """Gets a page of the games running in this process, for spectators to pick from"""
+        games = {room_id: game.title for room_id, game in self.rooms.games.items() if not game.game_end}
+        return paginate(games, page)
+
+    async def serve(
+        self,
+        port: int = 4000,
+        direct_port: Optional[int] = None,
+        metrics_port: Optional[int] = None,
+        metrics_file: Optional[str] = None,
+    ):
+        """Serves clients until interrupted
+
+        Args:
+            port: The port clients connect to, shared between every shard.
+            direct_port: The port only this shard listens on, which clients are
+                redirected to when joining a room owned by this shard.
+            metrics_port: The port to serve metrics on over HTTP, if any.
+            metrics_file: The file to write metrics to every few seconds, if any.
+        """
+        # Kept for as long as the server runs, as the event loop only holds weak references to tasks
+        reporting = start_reporting(metrics_port, metrics_file)
+        if self.game_log is not None:
+            self.game_log.start()
+
+        # Stop cleanly when terminated, so the last games are written to the log
+        with contextlib.suppress(NotImplementedError):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+        try:
+            async with contextlib.AsyncExitStack() as stack:
+                # reuse_port lets every shard listen on the same port, with the
+                # kernel spreading new connections between them
+                await stack.enter_async_context(serve(
+                    self.new_client, port=port, reuse_port=direct_port is not None, max_size=MAX_MESSAGE_SIZE
+                ))
+                if direct_port is not None:
+                    await stack.enter_async_context(serve(self.new_client, port=direct_port, max_size=MAX_MESSAGE_SIZE))
+
+                with contextlib.suppress(KeyboardInterrupt):
+                    await asyncio.Future()
+        finally:
+            for task in reporting:
+                task.cancel()
+
+            if self.game_log is not None:
+                await self.game_log.close()
+
+
+async def serve_shard(
+    shard: int,
+    port: int,
+    metrics_port: Optional[int],
+    metrics_file: Optional[str],
+    game_log_path: Optional[str],
+    message_rate: float,
+):
+    directory = ShardDirectory(Lobby(), shard, port + 1 + shard)
+    await directory.connect()
+
+    # Each shard has its own metrics, so give each one its own port or file
+    if metrics_port is not None:
+        metrics_port += shard
+    if metrics_file is not None:
+        path = Path(metrics_file)
+        metrics_file = str(path.with_name(f"{path.stem}-{shard}{path.suffix}"))
+
+    # Shards write their own segments, so no two processes append to the same file
+    game_log = None if game_log_path is None else GameLog(game_log_path, prefix=f"shard{shard}")
+
+    server = Server(directory, game_log, message_rate)
+    serving = asyncio.create_task(server.serve(port, directory.port, metrics_port, metrics_file))
+
+    # The coordinator is the parent process, so stop along with it
+    await directory.events
+    serving.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await serving
+
+def run_shard(
+    shard: int,
+    port: int,
+    metrics_port: Optional[int],
+    metrics_file: Optional[str],
+    game_log_path: Optional[str],
+    message_rate: float,
+):
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(serve_shard(shard, port, metrics_port, metrics_file, game_log_path, message_rate))
+
+# Mapped rather than loaded, so starting the server is instant and every server
+# process shares the same pages of the book.
+opening_book = OpeningBook.open()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the Connect 4 server")
+    parser.add_argument("--port", type=int, default=4000)
+    parser.add_argument(
+        "--shards", type=int, default=1,
+        help="The number of processes to spread games over, each also listens on port + 1 + its index",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, default=None,
+        help="Serves metrics over HTTP on localhost, shards use this port + their index",
+    )
+    parser.add_argument(
+        "--metrics-file", default=None,
+        help="Writes metrics to this file every 10 seconds, shards add their index to the name",
+    )
+    parser.add_argument("--game-log", default=GAME_LOG_PATH, help="The directory to record finished games in")
+    parser.add_argument("--no-game-log", action="store_true", help="Do not record finished games")
+    parser.add_argument(
+        "--rate-limit", type=float, default=MESSAGE_RATE,
+        help="The average number of messages per second each client can send, 0 for no limit",
+    )
+    args = parser.parse_args()
+
+    game_log_path = None if args.no_game_log else args.game_log
+    if args.shards == 1:
+        game_log = None if game_log_path is None else GameLog(game_log_path)
+        server = Server(game_log=game_log, message_rate=args.rate_limit)
+        with contextlib.suppress(asyncio.CancelledError):
+            asyncio.run(server.serve(args.port, metrics_port=args.metrics_port, metrics_file=args.metrics_file))
+    else:
+        shards = [
+            multiprocessing.Process(
+                target=run_shard,
+                args=(shard, args.port, args.metrics_port, args.metrics_file, game_log_path, args.rate_limit),
+                daemon=True,
+            )
+            for shard in range(args.shards)
+        ]
+        for process in shards:
+            process.start()
+
+        # The coordinator runs in this process, and the shards exit along with it
+        with contextlib.suppress(KeyboardInterrupt):
+            run_coordinator()
@@ -1,11 +1,18 @@
-from enum import Enum
-from typing import Any, Optional
+import asyncio
+import json
+import struct
+from enum import Enum, IntEnum
+from typing import Any, Awaitable, Iterable, NamedTuple, Optional, Union
 
 import pydantic
 from typing_extensions import Self
+from websockets.legacy.protocol import WebSocketCommonProtocol
+
+# Moves the cursor to the top left, then clears the screen and the scrollback
+CLEAR_SCREEN = "\33[H\33[2J\33[3J"
 
 def clear_screen():
-    print("\33[H\33[2J\33[3J", end="")
+    print(CLEAR_SCREEN, end="")
 
 
 class Cell(Enum):
@@ -40,6 +47,44 @@ class Cell(Enum):
             case Cell.YELLOW_PLAYER:
                 return Cell.RED_PLAYER
 
+# The largest number of rows or columns a board can be created with
+MAX_BOARD_SIZE = 255
+
+
+class Rules(NamedTuple):
+    """The size of the board and how many pieces in a row win, standard Connect 4 by default"""
+    rows: int = 6
+    columns: int = 7
+    connect: int = 4
+
+    @classmethod
+    def from_arguments(cls, arguments: dict[str, Any]) -> "Rules":
+        """Reads the rules from the arguments of a "create" message, any left out are the default
+
+        Raises:
+            ValueError: If the board is too big or small, or nobody could ever win on it
+        """
+        default = cls()
+        rules = cls(
+            arguments.get("rows", default.rows),
+            arguments.get("columns", default.columns),
+            arguments.get("connect", default.connect),
+        )
+
+        if any(type(value) is not int for value in rules):
+            raise ValueError('"rows", "columns" and "connect" must be whole numbers')
+
+        if not (1 <= rules.rows <= MAX_BOARD_SIZE and 1 <= rules.columns <= MAX_BOARD_SIZE):
+            raise ValueError(f"The board must be between 1 and {MAX_BOARD_SIZE} cells on each side")
+        if not 2 <= rules.connect <= max(rules.rows, rules.columns):
+            raise ValueError(f"Cannot get {rules.connect} in a row on a {rules.columns}x{rules.rows} board")
+
+        return rules
+
+    def __str__(self) -> str:
+        return f"{self.columns}x{self.rows}, connect {self.connect}"
+
+
 class ClientServerMessage(pydantic.BaseModel):
     c: str
     a: dict[str, Any]
@@ -47,11 +92,333 @@ class ClientServerMessage(pydantic.BaseModel):
 
 class CurrentRooms(pydantic.BaseModel):
     rooms: dict[int, str]
+    page: int = 0
+    pages: int = 1
+
+class LobbyUpdate(pydantic.BaseModel):
+    added: dict[int, str]
+    removed: list[int]
 
 class GameStart(pydantic.BaseModel):
     rows: int
     columns: int
+    # The number of pieces in a row needed to win
+    connect: int = 4
+    # Sent to players, to LOGIN with if the connection drops. None for spectators
+    token: Optional[str] = None
+    # The player this client plays as, None for spectators
+    player: Optional[Cell] = None
 
 class BoardUpdate(pydantic.BaseModel):
     board: list[list[Cell]]
     game_end: bool
+    draw: bool = False
+    seq: int = 0
+
+class MoveApplied(pydantic.BaseModel):
+    column: int
+    row: int
+    player: Cell
+    seq: int
+    game_end: bool
+    draw: bool = False
+
+class Redirect(pydantic.BaseModel):
+    # The port of the server process which owns the room
+    port: int
+    # None when redirected to resume a game, rather than to join a room
+    t: Optional[int]
+
+class Forfeit(pydantic.BaseModel):
+    # The player who left or ran out of time, the other player wins
+    player: Cell
+    seq: int
+
+class Error(pydantic.BaseModel):
+    # Why the last message was rejected, to show to the player
+    error: str
+
+
+class Encoding(Enum):
+    """How messages are sent over the websocket, chosen by the client at login"""
+    JSON = "json"
+    BINARY = "binary"
+
+
+# Every message type, in the order they are tried when working out the type of a JSON message
+MESSAGE_TYPES: tuple[type[pydantic.BaseModel], ...] = (
+    ClientServerMessage, CurrentRooms, LobbyUpdate, GameStart, BoardUpdate, MoveApplied, Redirect, Forfeit, Error
+)
+
+class Tag(IntEnum):
+    """The first byte of every binary frame, saying which message it holds"""
+    CLIENT_MESSAGE = 1
+    PLAY_PIECE = 2
+    CURRENT_ROOMS = 3
+    GAME_START = 4
+    BOARD_UPDATE = 5
+    MOVE_APPLIED = 6
+    LOBBY_UPDATE = 7
+    REDIRECT = 8
+    FORFEIT = 9
+    ERROR = 10
+
+TAG_BYTE = struct.Struct("<B")
+# target (-1 for None), length of command
+CLIENT_MESSAGE = struct.Struct("<iB")
+# column
+PLAY_PIECE = struct.Struct("<H")
+# page, number of pages, number of rooms, then a ROOM and the username for each
+CURRENT_ROOMS = struct.Struct("<III")
+# number of rooms, used for both the added rooms and removed ids of LOBBY_UPDATE
+COUNT = struct.Struct("<I")
+ROOM_ID = struct.Struct("<I")
+# room id, length of username
+ROOM = struct.Struct("<IB")
+# rows, columns, connect, player (0 for None), followed by the token if there is one
+GAME_START = struct.Struct("<HHBB")
+# rows, columns, flags, seq, followed by the board at 2 bits per cell
+BOARD_UPDATE = struct.Struct("<HHBI")
+# column, row, player, flags, seq
+MOVE_APPLIED = struct.Struct("<HHBBI")
+# port, room id (-1 for None)
+REDIRECT = struct.Struct("<Hi")
+# player, seq
+FORFEIT = struct.Struct("<BI")
+
+FLAG_GAME_END = 1
+FLAG_DRAW = 2
+
+
+def pack_flags(game_end: bool, draw: bool) -> int:
+    return (FLAG_GAME_END if game_end else 0) | (FLAG_DRAW if draw else 0)
+
+def pack_board(board: list[list[Cell]]) -> bytes:
+    """Packs the board 4 cells to a byte, using the 2 bit value of each Cell"""
+    cells = [cell.value for row in board for cell in row]
+    cells += [0] * (-len(cells) % 4)
+
+    return bytes(
+        cells[i] | cells[i + 1] << 2 | cells[i + 2] << 4 | cells[i + 3] << 6
+        for i in range(0, len(cells), 4)
+    )
+
+def unpack_board(data: bytes, rows: int, columns: int) -> list[list[Cell]]:
+    cells = [Cell((byte >> shift) & 0b11) for byte in data for shift in (0, 2, 4, 6)]
+    return [cells[row * columns:(row + 1) * columns] for row in range(rows)]
+
+def pack_rooms(rooms: dict[int, str]) -> bytes:
+    out = []
+    for room_id, username in rooms.items():
+        # Room names can have the rules added after the username, so may still need cutting.
+        # Dropping any character cut in half keeps it valid UTF-8.
+        encoded_username = username.encode()[:255].decode(errors="ignore").encode()
+        out.append(ROOM.pack(room_id, len(encoded_username)) + encoded_username)
+
+    return b"".join(out)
+
+def unpack_rooms(data: bytes, offset: int, count: int) -> tuple[dict[int, str], int]:
+    """Unpacks `count` rooms starting at `offset`, returning them and the offset after the last"""
+    rooms = {}
+    for _ in range(count):
+        room_id, username_length = ROOM.unpack_from(data, offset)
+        offset += ROOM.size
+
+        rooms[room_id] = data[offset:offset + username_length].decode()
+        offset += username_length
+
+    return rooms, offset
+
+def encode_binary(message: pydantic.BaseModel) -> bytes:
+    match message:
+        case ClientServerMessage(c="play_piece", a={"column": int(column)}, t=None):
+            # Sent every turn, so gets a dedicated frame instead of a generic one
+            return TAG_BYTE.pack(Tag.PLAY_PIECE) + PLAY_PIECE.pack(column)
+        case ClientServerMessage():
+            command = message.c.encode()
+            target = -1 if message.t is None else message.t
+            arguments = json.dumps(message.a, separators=(",", ":")).encode()
+            return TAG_BYTE.pack(Tag.CLIENT_MESSAGE) + CLIENT_MESSAGE.pack(target, len(command)) + command + arguments
+        case CurrentRooms():
+            header = CURRENT_ROOMS.pack(message.page, message.pages, len(message.rooms))
+            return TAG_BYTE.pack(Tag.CURRENT_ROOMS) + header + pack_rooms(message.rooms)
+        case LobbyUpdate():
+            removed = b"".join(ROOM_ID.pack(room_id) for room_id in message.removed)
+            return b"".join((
+                TAG_BYTE.pack(Tag.LOBBY_UPDATE),
+                COUNT.pack(len(message.added)),
+                pack_rooms(message.added),
+                COUNT.pack(len(message.removed)),
+                removed,
+            ))
+        case GameStart():
+            token = b"" if message.token is None else message.token.encode()
+            player = Cell.EMPTY if message.player is None else message.player
+            header = GAME_START.pack(message.rows, message.columns, message.connect, player.value)
+            return TAG_BYTE.pack(Tag.GAME_START) + header + token
+        case BoardUpdate():
+            rows = len(message.board)
+            columns = len(message.board[0]) if rows else 0
+            flags = pack_flags(message.game_end, message.draw)
+
+            header = BOARD_UPDATE.pack(rows, columns, flags, message.seq)
+            return TAG_BYTE.pack(Tag.BOARD_UPDATE) + header + pack_board(message.board)
+        case MoveApplied():
+            flags = pack_flags(message.game_end, message.draw)
+
+            body = MOVE_APPLIED.pack(message.column, message.row, message.player.value, flags, message.seq)
+            return TAG_BYTE.pack(Tag.MOVE_APPLIED) + body
+        case Redirect():
+            room_id = -1 if message.t is None else message.t
+            return TAG_BYTE.pack(Tag.REDIRECT) + REDIRECT.pack(message.port, room_id)
+        case Forfeit():
+            return TAG_BYTE.pack(Tag.FORFEIT) + FORFEIT.pack(message.player.value, message.seq)
+        case Error():
+            return TAG_BYTE.pack(Tag.ERROR) + message.error.encode()
+        case _:
+            raise TypeError(f"Cannot encode {type(message).__name__}")
+
+def decode_binary(data: bytes) -> pydantic.BaseModel:
+    (tag,) = TAG_BYTE.unpack_from(data)
+    offset = TAG_BYTE.size
+
+    match tag:
+        case Tag.CLIENT_MESSAGE:
+            target, command_length = CLIENT_MESSAGE.unpack_from(data, offset)
+            offset += CLIENT_MESSAGE.size
+
+            command = data[offset:offset + command_length].decode()
+            arguments = json.loads(data[offset + command_length:])
+            return ClientServerMessage(c=command, a=arguments, t=None if target == -1 else target)
+        case Tag.PLAY_PIECE:
+            (column,) = PLAY_PIECE.unpack_from(data, offset)
+            return ClientServerMessage(c="play_piece", a={"column": column})
+        case Tag.CURRENT_ROOMS:
+            page, pages, count = CURRENT_ROOMS.unpack_from(data, offset)
+            rooms, _ = unpack_rooms(data, offset + CURRENT_ROOMS.size, count)
+            return CurrentRooms(rooms=rooms, page=page, pages=pages)
+        case Tag.LOBBY_UPDATE:
+            (count,) = COUNT.unpack_from(data, offset)
+            added, offset = unpack_rooms(data, offset + COUNT.size, count)
+
+            (count,) = COUNT.unpack_from(data, offset)
+            removed = [room_id for (room_id,) in ROOM_ID.iter_unpack(data[offset + COUNT.size:])]
+            assert len(removed) == count
+
+            return LobbyUpdate(added=added, removed=removed)
+        case Tag.GAME_START:
+            rows, columns, connect, player = GAME_START.unpack_from(data, offset)
+            token = data[offset + GAME_START.size:].decode() or None
+            return GameStart(
+                rows=rows, columns=columns, connect=connect, token=token, player=None if player == 0 else Cell(player)
+            )
+        case Tag.BOARD_UPDATE:
+            rows, columns, flags, seq = BOARD_UPDATE.unpack_from(data, offset)
+            board = unpack_board(data[offset + BOARD_UPDATE.size:], rows, columns)
+
+            # The board has already been validated by the unpacking, so skip pydantic's checks
+            return BoardUpdate.construct(
+                board=board, game_end=bool(flags & FLAG_GAME_END), draw=bool(flags & FLAG_DRAW), seq=seq
+            )
+        case Tag.MOVE_APPLIED:
+            column, row, player, flags, seq = MOVE_APPLIED.unpack_from(data, offset)
+            return MoveApplied.construct(
+                column=column,
+                row=row,
+                player=Cell(player),
+                seq=seq,
+                game_end=bool(flags & FLAG_GAME_END),
+                draw=bool(flags & FLAG_DRAW),
+            )
+        case Tag.REDIRECT:
+            port, room_id = REDIRECT.unpack_from(data, offset)
+            return Redirect(port=port, t=None if room_id == -1 else room_id)
+        case Tag.FORFEIT:
+            player, seq = FORFEIT.unpack_from(data, offset)
+            return Forfeit(player=Cell(player), seq=seq)
+        case Tag.ERROR:
+            return Error(error=data[offset:].decode())
+        case _:
+            raise ValueError(f"Unknown message tag {tag}")
+
+def encode_message(message: pydantic.BaseModel, encoding: Encoding) -> Union[str, bytes]:
+    if encoding == Encoding.BINARY:
+        return encode_binary(message)
+
+    return message.json()
+
+def decode_message(raw: Union[str, bytes]) -> pydantic.BaseModel:
+    """Decodes a message from either encoding, binary frames are bytes and JSON is str"""
+    if isinstance(raw, bytes):
+        return decode_binary(raw)
+
+    data = json.loads(raw)
+    if not isinstance(data, dict):
+        raise ValueError(f"Unknown message {raw}")
+
+    for message_type in MESSAGE_TYPES:
+        fields = message_type.__fields__
+        required = {name for name, field in fields.items() if field.required}
+        if required <= data.keys() <= fields.keys():
+            return message_type.parse_obj(data)
+
+    raise ValueError(f"Unknown message {raw}")
+
+
+class Encoded:
+    """A message encoded at most once for each encoding, however many connections it is sent to"""
+
+    __slots__ = ("message", "frames")
+
+    message: pydantic.BaseModel
+    frames: dict[Encoding, Union[str, bytes]]
+
+    def __init__(self, message: pydantic.BaseModel) -> None:
+        self.message = message
+        self.frames = {}
+
+    def __getitem__(self, encoding: Encoding) -> Union[str, bytes]:
+        if (frame := self.frames.get(encoding)) is None:
+            frame = self.frames[encoding] = self.encode(encoding)
+
+        return frame
+
+    def encode(self, encoding: Encoding) -> Union[str, bytes]:
+        return encode_message(self.message, encoding)
+
+
+def send_to_all(
+    connections: Iterable["Connection"],
+    message: Union[pydantic.BaseModel, Encoded],
+    return_exceptions: bool = False,
+) -> Awaitable[list[Any]]:
+    """Sends a message to many connections, encoding it once for each encoding in use"""
+    encoded = message if isinstance(message, Encoded) else Encoded(message)
+    sends = [connection.websocket.send(encoded[connection.encoding]) for connection in connections]
+    return asyncio.gather(*sends, return_exceptions=return_exceptions)
+
+
+class Connection:
+    """A websocket which sends and receives messages in the encoding chosen at login"""
+
+    __slots__ = ("websocket", "encoding")
+
+    websocket: WebSocketCommonProtocol
+    encoding: Encoding
+
+    def __init__(self, websocket: WebSocketCommonProtocol, encoding: Encoding = Encoding.JSON) -> None:
+        self.websocket = websocket
+        self.encoding = encoding
+
+    async def send(self, message: pydantic.BaseModel):
+        await self.websocket.send(encode_message(message, self.encoding))
+
+    async def recv(self) -> pydantic.BaseModel:
+        return decode_message(await self.websocket.recv())
+
+    def __aiter__(self):
+        return self.messages()
+
+    async def messages(self):
+        async for raw in self.websocket:
+            yield decode_message(raw)
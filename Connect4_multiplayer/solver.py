@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple, Optional
+
+from ai import WIN_SCORE, Searcher
+from bitboard import Bitboard
+
+BOOK_PATH = "solver_book.json"
+
+# position key = (score, depth), loaded once in each worker process by `init_worker`
+book: dict[int, tuple[int, int]] = {}
+
+
+class MoveScore(NamedTuple):
+    column: int
+    # The score of the move for the player making it
+    score: int
+    depth: int
+    nodes: int
+    seconds: float
+    # The key of the position after the move, for storing in the book
+    key: int
+    from_book: bool
+
+
+def load_book(path: str) -> dict[int, tuple[int, int]]:
+    try:
+        with open(path) as book_file:
+            return {int(key): (score, depth) for key, (score, depth) in json.load(book_file).items()}
+    except FileNotFoundError:
+        return {}
+
+def save_book(path: str, new_book: dict[int, tuple[int, int]]):
+    """Writes the book to a temporary file first, so a crash never leaves it half written"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as book_file:
+        json.dump({str(key): entry for key, entry in new_book.items()}, book_file)
+
+    os.replace(temp_path, path)
+
+def init_worker(book_path: str):
+    global book
+    book = load_book(book_path)
+
+
+def board_from_moves(moves: list[int], columns: int, rows: int) -> Bitboard:
+    """Builds a board by playing each column in turn, starting with the first player"""
+    board = Bitboard(columns, rows)
+    for player, column in enumerate(moves):
+        if board.drop(column, player % 2) is None:
+            raise ValueError(f"Column {column + 1} is full")
+
+    return board
+
+def is_solved(board: Bitboard, score: int, depth: int) -> bool:
+    """Checks if a search result is the true result of the game, not just an estimate"""
+    return abs(score) > WIN_SCORE // 2 or depth >= board.rows * board.columns - board.moves
+
+def score_move(moves: list[int], column: int, columns: int, rows: int, time_budget: float) -> MoveScore:
+    """Scores a single root move, run inside a worker process"""
+    board = board_from_moves(moves, columns, rows)
+    player = board.moves % 2
+
+    row = board.drop(column, player)
+    assert row is not None
+
+    searcher = Searcher(time_budget)
+    searcher.setup(board)
+    key = searcher.key(board.masks[1 - player], board.occupied)
+
+    if board.has_won_at(row, column, player):
+        return MoveScore(column, WIN_SCORE - board.moves, 0, 0, 0.0, key, False)
+    if board.is_draw():
+        return MoveScore(column, 0, 0, 0, 0.0, key, False)
+
+    if (entry := book.get(key)) is not None and is_solved(board, *entry):
+        score, depth = entry
+        return MoveScore(column, -score, depth, 0, 0.0, key, True)
+
+    # The search scores the position for the opponent, who moves next
+    result = searcher.best_move(board, 1 - player)
+    return MoveScore(column, -result.score, result.depth, result.nodes, result.seconds, key, False)
+
+def solve(
+    moves: list[int],
+    columns: int = 7,
+    rows: int = 6,
+    time_budget: float = 10.0,
+    workers: Optional[int] = None,
+    book_path: str = BOOK_PATH,
+) -> dict[int, MoveScore]:
+    """Scores every possible move from a position, searching each one in its own process
+
+    Each worker loads the opening book from `book_path` when it starts, and any
+    results deeper than those already in the book are written back to it after.
+
+    Args:
+        moves: The columns played so far, starting with the first player.
+        columns: The number of columns on the board.
+        rows: The number of rows on the board.
+        time_budget: The number of seconds to search each move for.
+        workers: The number of processes to search with, defaults to one per core.
+        book_path: The file to load and save the opening book to.
+
+    Returns:
+        The score of each playable column, for the player to move
+    """
+    board = board_from_moves(moves, columns, rows)
+    root_moves = [c for c in range(columns) if not board.is_full(c)]
+
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(book_path,)) as executor:
+        futures = [
+            executor.submit(score_move, moves, column, columns, rows, time_budget)
+            for column in root_moves
+        ]
+        scores = {future.result().column: future.result() for future in futures}
+
+    new_book = load_book(book_path)
+    changed = False
+    for result in scores.values():
+        if result.from_book or result.nodes == 0:
+            continue
+
+        stored = new_book.get(result.key)
+        if stored is None or stored[1] < result.depth:
+            # Stored from the view of the player to move after the root move
+            new_book[result.key] = (-result.score, result.depth)
+            changed = True
+
+    if changed:
+        save_book(book_path, new_book)
+
+    return scores
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scores every move of a Connect 4 position in parallel")
+    parser.add_argument("moves", nargs="?", default="", help="The columns played so far, such as 4453")
+    parser.add_argument("--columns", type=int, default=7)
+    parser.add_argument("--rows", type=int, default=6)
+    parser.add_argument("--time", type=float, default=10.0, help="Seconds to search each move for")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--book", default=BOOK_PATH)
+    args = parser.parse_args()
+
+    scores = solve(
+        [int(c) - 1 for c in args.moves],
+        columns=args.columns,
+        rows=args.rows,
+        time_budget=args.time,
+        workers=args.workers,
+        book_path=args.book,
+    )
+
+    for column, result in sorted(scores.items()):
+        source = "book" if result.from_book else f"{result.nodes} nodes in {result.seconds:.2f}s"
+        print(f"Column {column + 1}: {result.score:>8} (depth {result.depth}, {source})")
@@ -0,0 +1,116 @@
+import asyncio
+import contextlib
+from typing import Callable, Optional, Union
+
+from websockets.exceptions import ConnectionClosed
+
+from metrics import metrics
+from shared import BoardUpdate, Connection, Encoded
+from validation import MeasuredEncoded
+
+# The most updates waiting to be sent to one spectator before it is resynced
+SPECTATOR_QUEUE_SIZE = 32
+
+
+class Spectator:
+    """A connection watching a game, sent updates by its own task from a bounded queue
+
+    The game never waits on a spectator. If a spectator falls so far behind that
+    its queue fills up, the queued updates are dropped and replaced with a single
+    BOARD_UPDATE of the whole board, which it can carry on from.
+    """
+
+    __slots__ = ("connection", "queue", "task")
+
+    connection: Connection
+    # Encoded frames to send, None once the game is over
+    queue: asyncio.Queue[Optional[Union[str, bytes]]]
+    task: asyncio.Task[None]
+
+    def __init__(self, connection: Connection) -> None:
+        self.connection = connection
+        # Unbounded, as the limit is checked in `offer` so a full queue can be replaced instead
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self.send_updates())
+
+    def clear(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    def offer(self, encoded: Encoded, resync: Callable[[], Encoded]) -> bool:
+        """Queues an update, or replaces everything queued with `resync` if the queue is full
+
+        Returns:
+            If the update was queued, otherwise the spectator was resynced
+        """
+        if self.queue.qsize() < SPECTATOR_QUEUE_SIZE:
+            self.queue.put_nowait(encoded[self.connection.encoding])
+            return True
+
+        self.clear()
+        self.queue.put_nowait(resync()[self.connection.encoding])
+        return False
+
+    async def send_updates(self):
+        with contextlib.suppress(ConnectionClosed):
+            while (frame := await self.queue.get()) is not None:
+                await self.connection.websocket.send(frame)
+
+
+class Audience:
+    """Every spectator of a game, sharing each encoded update between them"""
+
+    __slots__ = ("spectators",)
+
+    spectators: set[Spectator]
+
+    def __init__(self) -> None:
+        self.spectators = set()
+
+    def __len__(self) -> int:
+        return len(self.spectators)
+
+    def add(self, connection: Connection, start: list[Encoded]) -> Spectator:
+        """Adds a spectator, sending `start` to it before any updates"""
+        spectator = Spectator(connection)
+        for encoded in start:
+            spectator.queue.put_nowait(encoded[connection.encoding])
+
+        self.spectators.add(spectator)
+        spectator.task.add_done_callback(lambda _: self.spectators.discard(spectator))
+        return spectator
+
+    def publish(self, encoded: Encoded, board_update: Callable[[], BoardUpdate]):
+        """Queues an update for every spectator without waiting for any of them
+
+        Args:
+            encoded: The update to send.
+            board_update: Builds the whole board, for spectators too far behind for
+                the update. It is only built and encoded once, however many need it.
+        """
+        resync: Optional[Encoded] = None
+
+        def get_resync() -> Encoded:
+            nonlocal resync
+            if resync is None:
+                resync = MeasuredEncoded(board_update())
+
+            return resync
+
+        for spectator in self.spectators:
+            if not spectator.offer(encoded, get_resync):
+                metrics.increment("spectator_resyncs_total")
+
+    def close(self, final: BoardUpdate):
+        """Ends every spectator's updates once the game is over
+
+        Spectators that are behind are sent `final` instead of the moves they missed,
+        so every spectator sees the end of the game.
+        """
+        encoded = MeasuredEncoded(final)
+        for spectator in self.spectators:
+            if spectator.queue.qsize() >= SPECTATOR_QUEUE_SIZE:
+                spectator.clear()
+                spectator.queue.put_nowait(encoded[spectator.connection.encoding])
+
+            spectator.queue.put_nowait(None)
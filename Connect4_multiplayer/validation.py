@@ -0,0 +1,188 @@
+"""Checks on everything clients send, so one misbehaving client cannot crash games or hog the server
+
+Invalid messages are answered with ERROR and otherwise ignored, so a client can
+carry on from a mistake. Messages over the size limit close the connection
+before they are read, and each connection is rate limited.
+
+Sending is measured here too, rather than in `shared`, so the client does not
+record the server's metrics.
+"""
+
+import asyncio
+import contextlib
+import struct
+import time
+from typing import Any, Optional, Union
+
+import pydantic
+from websockets.exceptions import ConnectionClosedOK
+from websockets.legacy.protocol import WebSocketCommonProtocol
+
+from metrics import metrics
+from shared import ClientServerMessage, Connection, Encoded, Encoding, Error, decode_message
+
+# The largest websocket message accepted from a client, every valid message is far smaller.
+# Checked by websockets as the frame arrives, so bigger ones are never buffered or parsed.
+MAX_MESSAGE_SIZE = 4 * 1024
+# The average number of messages per second each connection can send
+MESSAGE_RATE = 20.0
+# The number of messages that can be sent at once, after being idle
+MESSAGE_BURST = 40
+# The longest username in bytes of UTF-8, so it fits the u8 length of a ROOM in binary
+MAX_USERNAME_BYTES = 255
+
+
+class MeasuredEncoded(Encoded):
+    """Records how long each encoding takes, use in place of `Encoded` for anything the server sends"""
+
+    __slots__ = ()
+
+    def encode(self, encoding: Encoding) -> Union[str, bytes]:
+        start = time.perf_counter()
+        frame = super().encode(encoding)
+        metrics.histogram("serialise_seconds").observe(time.perf_counter() - start)
+        return frame
+
+
+class InvalidMessage(ValueError):
+    """Raised for a message that cannot be acted on, the text is sent back to the client in ERROR"""
+
+
+class RateLimiter:
+    """A token bucket, allowing bursts of messages as long as the average rate stays under the limit"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    # Tokens added per second
+    rate: float
+    # The most tokens that can be saved up
+    burst: float
+    # Goes negative when over the limit, until the wait from `take` has passed
+    tokens: float
+    updated: float
+
+    def __init__(self, rate: float = MESSAGE_RATE, burst: float = MESSAGE_BURST) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Takes a token for one message
+
+        Returns:
+            The number of seconds to wait before handling the message, 0 if it is under the limit
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class ClientConnection(Connection):
+    """The server's side of a connection, which only hands over well formed client messages
+
+    A client sending too fast has its next message left unread until it is back
+    under the rate limit. Websockets stops reading from the socket once a few
+    messages are waiting, so a flood backs up onto the client instead of using
+    memory or CPU on the server.
+    """
+
+    __slots__ = ("limiter",)
+
+    # None if rate limiting is turned off
+    limiter: Optional[RateLimiter]
+
+    def __init__(
+        self, websocket: WebSocketCommonProtocol, encoding: Encoding = Encoding.JSON, rate: float = MESSAGE_RATE
+    ) -> None:
+        super().__init__(websocket, encoding)
+        self.limiter = RateLimiter(rate) if rate > 0 else None
+
+    async def send(self, message: pydantic.BaseModel):
+        await self.websocket.send(MeasuredEncoded(message)[self.encoding])
+
+    async def reject(self, reason: str):
+        """Tells the client a message was ignored, and why"""
+        metrics.increment("rejected_messages_total")
+        await self.send(Error(error=reason))
+
+    async def recv(self) -> ClientServerMessage:
+        """Waits for the next message which can be decoded, answering any others with ERROR"""
+        while True:
+            if self.limiter is not None and (wait := self.limiter.take()):
+                metrics.increment("rate_limited_messages_total")
+                await asyncio.sleep(wait)
+
+            raw = await self.websocket.recv()
+            try:
+                message = decode_message(raw)
+            # RecursionError is from JSON nested too deeply, which fits in far less than MAX_MESSAGE_SIZE
+            except (ValueError, TypeError, struct.error, RecursionError):
+                await self.reject("Could not read the message")
+                continue
+
+            if not isinstance(message, ClientServerMessage):
+                await self.reject(f"{type(message).__name__} is only sent by the server")
+                continue
+
+            return message
+
+    async def messages(self):
+        with contextlib.suppress(ConnectionClosedOK):
+            while True:
+                yield await self.recv()
+
+
+def int_argument(message: ClientServerMessage, name: str, default: Optional[int] = None) -> int:
+    """Gets a whole number from the arguments of a message
+
+    Raises:
+        InvalidMessage: If it is missing, with no default, or is not a whole number
+    """
+    value = message.a.get(name, default)
+    # bool is a subclass of int, but true is not a column
+    if type(value) is not int:
+        raise InvalidMessage(f'"{name}" must be a whole number')
+
+    return value
+
+def room_target(message: ClientServerMessage) -> int:
+    """Gets the room id a message is for
+
+    Raises:
+        InvalidMessage: If the message has no room id
+    """
+    if message.t is None:
+        raise InvalidMessage(f'"{message.c}" needs the room id in "t"')
+
+    return message.t
+
+def parse_login(raw: Union[str, bytes]) -> ClientServerMessage:
+    """Reads the first message on a connection, which is always a JSON LOGIN
+
+    Raises:
+        InvalidMessage: If it is anything else, or the username, token or seq are the wrong type
+    """
+    try:
+        message = ClientServerMessage.parse_raw(raw)
+    except (ValueError, RecursionError):
+        raise InvalidMessage("The first message must be LOGIN, sent as JSON") from None
+
+    arguments: dict[str, Any] = message.a
+    if message.c != "login":
+        raise InvalidMessage("The first message must be LOGIN, sent as JSON")
+    if not isinstance(arguments.get("username"), str) or not arguments["username"]:
+        raise InvalidMessage('"username" must be a string, and not empty')
+    if len(arguments["username"].encode()) > MAX_USERNAME_BYTES:
+        raise InvalidMessage(f'"username" cannot be over {MAX_USERNAME_BYTES} bytes')
+    if not isinstance(arguments.get("token") or "", str):
+        raise InvalidMessage('"token" must be a string')
+
+    seq = int_argument(message, "seq", 0)
+    if seq < 0:
+        raise InvalidMessage('"seq" cannot be negative')
+
+    return message
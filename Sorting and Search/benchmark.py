@@ -0,0 +1,426 @@
+"""Benchmarks every sort in `sorts.__all__` and search in `searches.__all__` over a sweep of sizes
+
+Each algorithm is run on every input distribution at every size, recording:
+- the best wall time of `--repeat` runs
+- comparisons made between items
+- writes of items into the list being sorted, including slices, copies and scratch buffers taken of it
+- peak memory allocated while running, on top of the input itself
+
+The inputs come from a fixed seed, so the counts are exactly the same between
+runs unless an algorithm changes. Save the results with `--json`, then pass the
+file to `--compare` on another commit to flag anything which got slower or does
+more work, exiting with 1 if anything did. Times only count as slower by over
+`--min-slowdown`, as a tiny run can easily take twice as long from noise alone.
+
+Sizes an algorithm is expected to take over `--time-limit` on are skipped, so
+the quadratic sorts stop early instead of taking hours on the larger sizes.
+"""
+
+from __future__ import annotations
+
+import argparse
+import collections
+import csv
+import json
+import math
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from typing import Callable, NamedTuple, Optional
+
+import sorts, searches
+
+SIZES = (10**2, 10**3, 10**4, 10**5, 10**6, 10**7)
+# The proportion of items swapped with a random other item in a nearly sorted list
+NEARLY_SORTED_SWAPS = 0.01
+
+
+class Counted(int):
+    # An int which counts every comparison made with it, to count them without changing the algorithms
+    __slots__ = ()
+
+    comparisons = 0
+
+    def __lt__(self, other):
+        Counted.comparisons += 1
+        return int.__lt__(self, other)
+
+    def __le__(self, other):
+        Counted.comparisons += 1
+        return int.__le__(self, other)
+
+    def __gt__(self, other):
+        Counted.comparisons += 1
+        return int.__gt__(self, other)
+
+    def __ge__(self, other):
+        Counted.comparisons += 1
+        return int.__ge__(self, other)
+
+    def __eq__(self, other):
+        Counted.comparisons += 1
+        return int.__eq__(self, other)
+
+    def __ne__(self, other):
+        Counted.comparisons += 1
+        return int.__ne__(self, other)
+
+    # Defining __eq__ removes the inherited __hash__
+    __hash__ = int.__hash__
+
+class CountedList(list):
+    # A list which counts every item written into it, or into slices and copies of it
+    __slots__ = ()
+
+    writes = 0
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            CountedList.writes += len(value)
+        else:
+            CountedList.writes += 1
+
+        super().__setitem__(index, value)
+
+    def __getitem__(self, index):
+        item = super().__getitem__(index)
+        return CountedList(item) if isinstance(index, slice) else item
+
+    def copy(self) -> CountedList:
+        return CountedList(self)
+
+
+class Result(NamedTuple):
+    kind: str
+    algorithm: str
+    distribution: str
+    size: int
+    # The best time of all the repeats. For searches, per search.
+    seconds: float
+    # None if not measured. For searches, per search.
+    comparisons: Optional[float]
+    writes: Optional[int]
+    peak_bytes: Optional[int]
+
+    def key(self) -> tuple[str, str, str, int]:
+        return (self.kind, self.algorithm, self.distribution, self.size)
+
+
+def random_list(rng: random.Random, size: int) -> list[int]:
+    return rng.choices(range(size), k=size)
+
+def sorted_list(rng: random.Random, size: int) -> list[int]:
+    return sorted(random_list(rng, size))
+
+def reversed_list(rng: random.Random, size: int) -> list[int]:
+    return sorted(random_list(rng, size), reverse=True)
+
+def few_unique_list(rng: random.Random, size: int) -> list[int]:
+    return rng.choices(range(10), k=size)
+
+def nearly_sorted_list(rng: random.Random, size: int) -> list[int]:
+    arr = sorted_list(rng, size)
+    for _ in range(max(1, int(size * NEARLY_SORTED_SWAPS))):
+        i, j = rng.randrange(size), rng.randrange(size)
+        arr[i], arr[j] = arr[j], arr[i]
+
+    return arr
+
+DISTRIBUTIONS: dict[str, Callable[[random.Random, int], list[int]]] = {
+    "random": random_list,
+    "sorted": sorted_list,
+    "reversed": reversed_list,
+    "few_unique": few_unique_list,
+    "nearly_sorted": nearly_sorted_list,
+}
+
+
+def time_sort(sort: Callable[[list[int]], None], data: list[int], repeat: int, time_limit: float) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        arr = data.copy()
+
+        start = time.perf_counter()
+        sort(arr)
+        best = min(best, time.perf_counter() - start)
+
+        # Repeating something this slow would not change the result much
+        if best > time_limit:
+            break
+
+    return best
+
+def count_sort(sort: Callable[[list[int]], None], data: list[int]) -> tuple[int, int]:
+    arr = CountedList(map(Counted, data))
+    Counted.comparisons = CountedList.writes = 0
+
+    sort(arr)
+    counts = (Counted.comparisons, CountedList.writes)
+    assert arr == sorted(data), f"{sort.__name__} did not sort the list"
+
+    return counts
+
+def measure_memory(function: Callable[[], object]) -> int:
+    # Only allocations made after tracing starts are counted, so the input is left out
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def search_targets(rng: random.Random, data: list[int], count: int) -> list[int]:
+    # Mostly items in the list, with some that are not so the worst case is included too
+    present = rng.choices(data, k=count - count // 10)
+    missing = [-1] * (count // 10)
+    return present + missing
+
+def time_search(
+    search: Callable[[list[int], int], Optional[int]], data: list[int], targets: list[int], repeat: int
+) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for target in targets:
+            search(data, target)
+        best = min(best, time.perf_counter() - start)
+
+    return best / len(targets)
+
+def count_search(search: Callable[[list[int], int], Optional[int]], data: list[int], targets: list[int]) -> float:
+    arr = list(map(Counted, data))
+    Counted.comparisons = 0
+
+    indexes = [search(arr, Counted(target)) for target in targets]
+    comparisons = Counted.comparisons / len(targets)
+
+    for index, target in zip(indexes, targets):
+        assert index is None or arr[index] == target, f"{search.__name__} found the wrong item"
+
+    return comparisons
+
+
+def estimate_seconds(timings: list[tuple[int, float]], size: int) -> float:
+    """Estimates how long an algorithm will take at `size`, from how its time grew between the last two sizes
+
+    Args:
+        timings: The size and time of every run so far, smallest first.
+
+    Returns:
+        The estimate, assuming the time grows linearly if there is only one timing to go from, or 0 if there are none
+    """
+    if not timings:
+        return 0.0
+
+    last_size, last_seconds = timings[-1]
+    exponent = 1.0
+    if len(timings) > 1:
+        previous_size, previous_seconds = timings[-2]
+        if previous_seconds > 0 and last_seconds > 0 and last_size != previous_size:
+            exponent = max(0.0, math.log(last_seconds / previous_seconds) / math.log(last_size / previous_size))
+
+    return last_seconds * (size / last_size) ** exponent
+
+def run(args: argparse.Namespace) -> list[Result]:
+    sort_names = [name for name in sorts.__all__ if not args.algorithms or name in args.algorithms]
+    search_names = [name for name in searches.__all__ if not args.algorithms or name in args.algorithms]
+
+    # (algorithm, distribution) = the size and total time of each run. Any size that is expected to take
+    # over the time limit is skipped, along with every size after it.
+    timings: collections.defaultdict[tuple[str, str], list[tuple[int, float]]] = collections.defaultdict(list)
+    too_slow: set[tuple[str, str]] = set()
+    results = []
+
+    def should_skip(name: str, distribution: str, size: int) -> bool:
+        if estimate_seconds(timings[name, distribution], size) > args.time_limit:
+            too_slow.add((name, distribution))
+
+        return (name, distribution) in too_slow
+
+    def record(name: str, distribution: str, size: int, seconds: float) -> bool:
+        # Returns if the run went over the time limit, in which case the slower counting
+        # and memory passes are skipped too, as they would take even longer
+        timings[name, distribution].append((size, seconds))
+        if seconds > args.time_limit:
+            too_slow.add((name, distribution))
+
+        return seconds > args.time_limit
+
+    for size in sorted(args.sizes):
+        for distribution in args.distributions:
+            # Seeded by the inputs, so adding or removing sizes does not change the other lists
+            rng = random.Random(f"{args.seed}-{distribution}-{size}")
+            data = DISTRIBUTIONS[distribution](rng, size)
+
+            for name in sort_names:
+                if should_skip(name, distribution, size):
+                    continue
+
+                sort = getattr(sorts, name)
+                seconds = time_sort(sort, data, args.repeat, args.time_limit)
+                over_limit = record(name, distribution, size, seconds)
+
+                comparisons = writes = None
+                if not args.no_counts and not over_limit:
+                    comparisons, writes = count_sort(sort, data)
+
+                peak_bytes = None
+                if not args.no_memory and not over_limit:
+                    arr = data.copy()
+                    peak_bytes = measure_memory(lambda: sort(arr))
+
+                results.append(Result("sort", name, distribution, size, seconds, comparisons, writes, peak_bytes))
+                report(results[-1])
+
+            # Binary search needs a sorted list, so every search gets the same one
+            data.sort()
+            targets = search_targets(rng, data, args.searches)
+
+            for name in search_names:
+                if should_skip(name, distribution, size):
+                    continue
+
+                search = getattr(searches, name)
+                # Converted before timing, as a NumPy search would otherwise copy the whole list every search
+                seconds = time_search(search, searches.prepare(search, data), targets, args.repeat)
+                over_limit = record(name, distribution, size, seconds * len(targets))
+
+                comparisons = None
+                if not args.no_counts and not over_limit:
+                    comparisons = count_search(search, data, targets)
+
+                results.append(Result("search", name, distribution, size, seconds, comparisons, None, None))
+                report(results[-1])
+
+    return results
+
+def format_seconds(seconds: float) -> str:
+    # Searches take well under a millisecond, which would otherwise all show as 0.000ms
+    return f"{seconds * 1000:.3f}ms" if seconds >= 0.001 else f"{seconds * 1_000_000:.3f}us"
+
+def report(result: Result):
+    measured = [format_seconds(result.seconds)]
+    if result.comparisons is not None:
+        measured.append(f"{result.comparisons:,.0f} comparisons")
+    if result.writes is not None:
+        measured.append(f"{result.writes:,} writes")
+    if result.peak_bytes is not None:
+        measured.append(f"{result.peak_bytes / 1024:,.1f} KiB peak")
+
+    print(f"{result.algorithm} on {result.size:,} {result.distribution} items: {', '.join(measured)}", flush=True)
+
+
+def compare(
+    results: list[Result], baseline_path: str, threshold: float, min_slowdown: float, searches: int, seed: int
+) -> list[str]:
+    """Finds every result which is worse than the same one in a previous run
+
+    Args:
+        threshold: How many times slower, or more memory, counts as worse. The
+            comparisons and writes are exact, so any increase counts.
+        min_slowdown: The seconds a run has to slow down by as well to count as worse,
+            for searches over the whole batch of `searches` rather than each one.
+        seed: The seed used for this run, the counts are only compared if the
+            baseline used the same one, as otherwise the inputs were different.
+
+    Returns:
+        A description of each regression
+    """
+    with open(baseline_path) as baseline_file:
+        raw_baseline = json.load(baseline_file)
+
+    old_results = [Result(**raw) for raw in raw_baseline["results"]]
+    same_inputs = raw_baseline["seed"] == seed
+    if not same_inputs:
+        print(f"{baseline_path} used seed {raw_baseline['seed']}, so only times and memory are compared")
+
+    baseline = {result.key(): result for result in old_results}
+
+    regressions = []
+    for result in results:
+        if (old := baseline.get(result.key())) is None:
+            continue
+
+        label = f"{result.algorithm} on {result.size:,} {result.distribution} items"
+        runs = searches if result.kind == "search" else 1
+        if result.seconds > old.seconds * threshold and (result.seconds - old.seconds) * runs > min_slowdown:
+            regressions.append(f"{label}: {format_seconds(old.seconds)} -> {format_seconds(result.seconds)}")
+        for field in ("comparisons", "writes"):
+            new_value, old_value = getattr(result, field), getattr(old, field)
+            if same_inputs and new_value is not None and old_value is not None and new_value > old_value:
+                regressions.append(f"{label}: {old_value:,.0f} -> {new_value:,.0f} {field}")
+        if result.peak_bytes is not None and old.peak_bytes is not None and (
+            result.peak_bytes > old.peak_bytes * threshold
+        ):
+            regressions.append(f"{label}: {old.peak_bytes:,} -> {result.peak_bytes:,} bytes peak")
+
+    return regressions
+
+def write_csv(results: list[Result], path: str):
+    with open(path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(Result._fields)
+        writer.writerows(results)
+
+def write_json(results: list[Result], path: str, args: argparse.Namespace):
+    with open(path, "w") as json_file:
+        json.dump({
+            "python": platform.python_version(),
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "results": [result._asdict() for result in results],
+        }, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    def comma_list(converter: Callable[[str], object]) -> Callable[[str], list]:
+        return lambda raw: [converter(part) for part in raw.split(",") if part]
+
+    parser = argparse.ArgumentParser(description="Benchmarks the sorting and searching algorithms")
+    parser.add_argument("--sizes", type=comma_list(lambda raw: int(float(raw))), default=SIZES,
+                        help="Comma separated list sizes, such as 1e2,1e3,1e4")
+    parser.add_argument("--distributions", type=comma_list(str), default=list(DISTRIBUTIONS),
+                        help=f"Comma separated, from {', '.join(DISTRIBUTIONS)}")
+    parser.add_argument("--algorithms", type=comma_list(str), default=[],
+                        help="Comma separated function names to run, by default all of them")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs to take the best time from")
+    parser.add_argument("--searches", type=int, default=100, help="Searches to run at each size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--time-limit", type=float, default=5.0,
+                        help="Skips sizes an algorithm is expected to take longer than this many seconds on, "
+                             "estimated from how its time grew over the smaller sizes")
+    parser.add_argument("--no-counts", action="store_true",
+                        help="Skips counting comparisons and writes, which runs each algorithm again much slower")
+    parser.add_argument("--no-memory", action="store_true", help="Skips measuring peak memory")
+    parser.add_argument("--csv", help="Writes the results to this CSV file")
+    parser.add_argument("--json", help="Writes the results to this JSON file, to be used with --compare later")
+    parser.add_argument("--compare", help="A JSON file from a previous run to check for regressions against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="How many times slower, or more memory, is a regression")
+    parser.add_argument("--min-slowdown", type=float, default=0.001,
+                        help="Seconds a run must also slow down by to be a regression, over all the searches "
+                             "for a search")
+    args = parser.parse_args()
+
+    if unknown := set(args.distributions) - DISTRIBUTIONS.keys():
+        parser.error(f"Unknown distributions: {', '.join(unknown)}")
+    if unknown := set(args.algorithms) - {*sorts.__all__, *searches.__all__}:
+        parser.error(f"Unknown algorithms: {', '.join(unknown)}")
+
+    results = run(args)
+
+    if args.csv:
+        write_csv(results, args.csv)
+    if args.json:
+        write_json(results, args.json, args)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold, args.min_slowdown, args.searches, args.seed)
+        print(f"{len(regressions)} regressions against {args.compare}")
+        for regression in regressions:
+            print(regression)
+
+        sys.exit(1 if regressions else 0)
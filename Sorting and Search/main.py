@@ -4,6 +4,7 @@ import random
 from typing import Callable, Optional, TypeVar
 
 import sorts, searches
+from numpy_backend import HAS_NUMPY
 
 T = TypeVar("T")
 
@@ -26,7 +27,7 @@ class SearchingAlgorithm(MenuItem):
         to_search = get_array()
         item = int(input("Enter item to search for: "))
 
-        index = self.search(to_search, item)
+        index = self.search(searches.prepare(self.search, to_search), item)
         if index is None:
             print(f"{item} not found in array")
         else:
@@ -71,10 +72,9 @@ def test_all():
 
     assert correct_index != -1
 
-    print(f"Testing linear search with array {test_arr} and item {test_item}")
-    assert searches.linear_search(test_arr, test_item) == correct_index
-    print(f"Testing binary search with array {test_arr} and item {test_item}")
-    assert searches.binary_search(test_arr, test_item) == correct_index
+    for search in searches.__all__:
+        print(f"Testing {search} with array {test_arr} and item {test_item}")
+        assert getattr(searches, search)(test_arr, test_item) == correct_index
 
     for sort in sorts.__all__:
         rand_arr = random_array()
@@ -92,6 +92,16 @@ main_menu = (
     SortingAlgorithm("Bubble Sort", sorts.bubble_sort),
     SortingAlgorithm("Insertion Sort", sorts.insertion_sort),
     SortingAlgorithm("Merge Sort", sorts.merge_sort),
+    SortingAlgorithm("Bottom Up Merge Sort", sorts.bottom_up_merge_sort),
+    SortingAlgorithm("Hybrid Sort", sorts.hybrid_sort),
+    SortingAlgorithm("Introsort", sorts.intro_sort),
+    SortingAlgorithm("Radix Sort", sorts.radix_sort),
+    # Only listed if NumPy is installed
+    *((
+        SearchingAlgorithm("NumPy Linear Search", searches.numpy_linear_search),
+        SearchingAlgorithm("NumPy Binary Search", searches.numpy_binary_search),
+        SortingAlgorithm("NumPy Sort", sorts.numpy_sort),
+    ) if HAS_NUMPY else ()),
     MenuItem("Run tests", test_all),
 )
 
@@ -0,0 +1,28 @@
+"""The optional NumPy backend, used by `sorts.numpy_sort` and the `searches.numpy_*` functions
+
+NumPy is not needed for anything else, so those are only exported when it is installed.
+"""
+
+from array import array
+from typing import Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HAS_NUMPY = np is not None
+
+# Anything the NumPy sorts and searches accept
+Numbers = Union[list[int], array, "np.ndarray"]
+
+def as_array(values: Numbers) -> "np.ndarray":
+    # NumPy arrays are used as they are, and `array.array` is viewed through its buffer,
+    # so sorting the result sorts the original without copying it. A list holds pointers
+    # to Python ints rather than the numbers themselves, so is the only one copied
+    if isinstance(values, np.ndarray):
+        return values
+    if isinstance(values, array):
+        return np.asarray(memoryview(values))
+
+    return np.asarray(values)
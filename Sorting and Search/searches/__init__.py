@@ -1,4 +1,24 @@
+from typing import Callable
+
+from numpy_backend import HAS_NUMPY, Numbers, as_array
+
 from .linear import linear_search
 from .binary import binary_search
 
+# Only searches for a single item, as every search in here is run the same way by the tests and benchmark
 __all__ = ("linear_search", "binary_search")
+# The searches which work on a NumPy array, and copy any list they are given into one
+NUMPY_SEARCHES: tuple[Callable, ...] = ()
+
+if HAS_NUMPY:
+    from .vectorised import numpy_linear_search, numpy_binary_search, numpy_binary_search_many
+
+    __all__ += ("numpy_linear_search", "numpy_binary_search")
+    NUMPY_SEARCHES = (numpy_linear_search, numpy_binary_search)
+
+def prepare(search: Callable, array: list[int]) -> Numbers:
+    # Converts a list once into what `search` works on, so it is not copied again on every search
+    if search in NUMPY_SEARCHES:
+        return as_array(array)
+
+    return array
@@ -0,0 +1,41 @@
+from typing import Optional
+
+from numpy_backend import Numbers, as_array, np
+
+# Linear search compares this many items at a time, so finding an item near the start
+# stops early and the temporary array of matches stays small
+LINEAR_CHUNK = 64 * 1024
+
+# A list passed to the single item searches is copied into a NumPy array on every call, which is
+# O(n) and so far slower than the search itself. Anything searching the same list more than once
+# should convert it first with `searches.prepare`, or use `numpy_binary_search_many`.
+
+def numpy_linear_search(array: Numbers, item: int) -> Optional[int]:
+    values = as_array(array)
+
+    for start in range(0, len(values), LINEAR_CHUNK):
+        matches = np.flatnonzero(values[start:start + LINEAR_CHUNK] == item)
+        if len(matches):
+            return start + int(matches[0])
+
+    return None
+
+def numpy_binary_search(array: Numbers, item: int) -> Optional[int]:
+    values = as_array(array)
+    index = int(np.searchsorted(values, item))
+
+    if index < len(values) and values[index] == item:
+        return index
+
+    return None
+
+def numpy_binary_search_many(array: Numbers, items: Numbers) -> "np.ndarray":
+    # Searches for every item in one call, returning the index of each or -1 if it is not in `array`
+    values = as_array(array)
+    targets = as_array(items)
+
+    indexes = np.searchsorted(values, targets)
+    found = indexes < len(values)
+    found[found] = values[indexes[found]] == targets[found]
+
+    return np.where(found, indexes, -1)
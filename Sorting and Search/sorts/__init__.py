@@ -1,5 +1,17 @@
-from .merge import merge_sort
+from numpy_backend import HAS_NUMPY
+
+from .merge import merge_sort, bottom_up_merge_sort
 from .bubble import bubble_sort
 from .insertion import insertion_sort
+from .hybrid import hybrid_sort
+from .intro import intro_sort
+from .radix import radix_sort
+
+__all__ = (
+    "merge_sort", "bubble_sort", "insertion_sort", "bottom_up_merge_sort", "hybrid_sort", "intro_sort", "radix_sort"
+)
+
+if HAS_NUMPY:
+    from .vectorised import numpy_sort
 
-__all__ = ("merge_sort", "bubble_sort", "insertion_sort")
+    __all__ += ("numpy_sort",)
@@ -0,0 +1,49 @@
+from .insertion import insertion_sort_range
+from .merge import merge_runs
+
+# Runs shorter than this are extended with insertion sort, so there are never
+# lots of tiny runs to merge
+MIN_RUN = 32
+
+def hybrid_sort(arr: list[int]):
+    # Similar to Timsort, finds the runs which are already in order, makes any
+    # short ones up to MIN_RUN long with insertion sort, then merges them. Data
+    # that is mostly sorted has few, long runs, so takes far fewer comparisons
+    boundaries = [0]
+    start = 0
+
+    while start < len(arr):
+        end = find_run(arr, start)
+        if end - start < MIN_RUN:
+            end = min(start + MIN_RUN, len(arr))
+            insertion_sort_range(arr, start, end)
+
+        boundaries.append(end)
+        start = end
+
+    merge_runs(arr, boundaries)
+
+def find_run(arr: list[int], start: int) -> int:
+    # Returns the end of the run starting at `start`, reversing it if it is descending
+    end = start + 1
+    if end == len(arr):
+        return end
+
+    if arr[end] < arr[start]:
+        # Only strictly descending, so reversing it never swaps equal items
+        while end < len(arr) and arr[end] < arr[end - 1]:
+            end += 1
+
+        reverse_range(arr, start, end)
+    else:
+        while end < len(arr) and arr[end] >= arr[end - 1]:
+            end += 1
+
+    return end
+
+def reverse_range(arr: list[int], start: int, end: int):
+    i, j = start, end - 1
+    while i < j:
+        arr[i], arr[j] = arr[j], arr[i]
+        i += 1
+        j -= 1
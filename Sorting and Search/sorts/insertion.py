@@ -1,8 +1,13 @@
 def insertion_sort(arr: list[int]):
-    for i, item in enumerate(arr):
+    insertion_sort_range(arr, 0, len(arr))
+
+def insertion_sort_range(arr: list[int], start: int, end: int):
+    # Sorts arr[start:end] in place, used by the hybrid sorts for short runs
+    for i in range(start + 1, end):
+        item = arr[i]
         j = i - 1
 
-        while j >= 0 and item < arr[j]:
+        while j >= start and item < arr[j]:
             arr[j + 1] = arr[j]
             j -= 1
 
@@ -0,0 +1,83 @@
+from .insertion import insertion_sort_range
+
+# Ranges this short are left to insertion sort instead of being partitioned further
+SMALL_RANGE = 16
+
+def intro_sort(arr: list[int]):
+    # Quicksort, but switching to heapsort for any range that has been partitioned too
+    # many times, which only happens with bad pivots, so it is never worse than O(n log n)
+    intro_sort_range(arr, 0, len(arr), 2 * len(arr).bit_length())
+
+def intro_sort_range(arr: list[int], start: int, end: int, depth_limit: int):
+    while end - start > SMALL_RANGE:
+        if depth_limit == 0:
+            heap_sort_range(arr, start, end)
+            return
+
+        depth_limit -= 1
+        split = partition(arr, start, end)
+
+        # Recursing into the smaller side and looping on the larger keeps the
+        # recursion under log2(n) deep, however the pivots turn out
+        if split - start < end - split:
+            intro_sort_range(arr, start, split, depth_limit)
+            start = split
+        else:
+            intro_sort_range(arr, split, end, depth_limit)
+            end = split
+
+    insertion_sort_range(arr, start, end)
+
+def partition(arr: list[int], start: int, end: int) -> int:
+    # Hoare partitioning around the median of the first, middle and last items.
+    # Returns `split`, where everything before it is <= everything from it onwards
+    mid = (start + end - 1) // 2
+    last = end - 1
+
+    # Sorting the three candidates puts the median in the middle
+    if arr[mid] < arr[start]:
+        arr[start], arr[mid] = arr[mid], arr[start]
+    if arr[last] < arr[mid]:
+        arr[mid], arr[last] = arr[last], arr[mid]
+        if arr[mid] < arr[start]:
+            arr[start], arr[mid] = arr[mid], arr[start]
+
+    pivot = arr[mid]
+    i, j = start - 1, end
+
+    while True:
+        i += 1
+        while arr[i] < pivot:
+            i += 1
+
+        j -= 1
+        while arr[j] > pivot:
+            j -= 1
+
+        if i >= j:
+            return j + 1
+
+        arr[i], arr[j] = arr[j], arr[i]
+
+def heap_sort_range(arr: list[int], start: int, end: int):
+    length = end - start
+
+    # Build a max heap, then repeatedly move the largest item to the end
+    for root in range(length // 2 - 1, -1, -1):
+        sift_down(arr, start, root, length)
+
+    for last in range(length - 1, 0, -1):
+        arr[start], arr[start + last] = arr[start + last], arr[start]
+        sift_down(arr, start, 0, last)
+
+def sift_down(arr: list[int], offset: int, root: int, length: int):
+    # Moves arr[offset + root] down the heap stored in arr[offset:offset + length]
+    while (child := 2 * root + 1) < length:
+        if child + 1 < length and arr[offset + child] < arr[offset + child + 1]:
+            child += 1
+
+        if arr[offset + root] >= arr[offset + child]:
+            return
+
+        arr[offset + root], arr[offset + child] = arr[offset + child], arr[offset + root]
+        root = child
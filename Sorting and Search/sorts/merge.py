@@ -1,3 +1,5 @@
+from .insertion import insertion_sort_range
+
 def merge_sort(arr: list[int]):
     if len(arr) <= 1:
         return
@@ -43,3 +45,69 @@ def merge(left: list[int], right: list[int], arr: list[int]):
         arr[k] = right[j]
         j += 1
         k += 1
+
+# Chunks of this many items are insertion sorted before the bottom up merge sort
+# starts merging, as insertion sort is faster on tiny lists
+CHUNK_SIZE = 32
+
+def bottom_up_merge_sort(arr: list[int]):
+    # Sorts chunks then merges neighbouring ones, instead of splitting recursively,
+    # so the only list allocated is the one scratch buffer in `merge_runs`
+    for start in range(0, len(arr), CHUNK_SIZE):
+        insertion_sort_range(arr, start, min(start + CHUNK_SIZE, len(arr)))
+
+    merge_runs(arr, [*range(0, len(arr), CHUNK_SIZE), len(arr)])
+
+def merge_runs(arr: list[int], boundaries: list[int]):
+    # `boundaries` is the start of each sorted run in arr, followed by len(arr).
+    # Each pass merges pairs of neighbouring runs from one list into the other,
+    # swapping which is which every pass, so nothing is copied back until the end
+    buffer = arr.copy()
+    source, dest = arr, buffer
+
+    while len(boundaries) > 2:
+        merged = [0]
+        for i in range(0, len(boundaries) - 2, 2):
+            start, mid, end = boundaries[i], boundaries[i + 1], boundaries[i + 2]
+            merge_range(source, dest, start, mid, end)
+            merged.append(end)
+
+        # An odd run out has nothing to merge with this pass, so is only moved across
+        if len(boundaries) % 2 == 0:
+            start, end = boundaries[-2], boundaries[-1]
+            dest[start:end] = source[start:end]
+            merged.append(end)
+
+        source, dest = dest, source
+        boundaries = merged
+
+    if source is not arr:
+        arr[:] = source
+
+def merge_range(source: list[int], dest: list[int], start: int, mid: int, end: int):
+    # The same as `merge`, but merging source[start:mid] and source[mid:end]
+    # into dest[start:end] by index instead of taking copies of each half
+    i, j, k = start, mid, start
+
+    while i < mid and j < end:
+        left_elm = source[i]
+        right_elm = source[j]
+
+        if left_elm <= right_elm:
+            dest[k] = left_elm
+            i += 1
+        else:
+            dest[k] = right_elm
+            j += 1
+
+        k += 1
+
+    while i < mid:
+        dest[k] = source[i]
+        i += 1
+        k += 1
+
+    while j < end:
+        dest[k] = source[j]
+        j += 1
+        k += 1
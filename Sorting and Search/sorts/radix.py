@@ -0,0 +1,48 @@
+# The number of bits sorted by in each pass, so there are 2 ** RADIX_BITS buckets
+RADIX_BITS = 8
+
+def radix_sort(arr: list[int]):
+    # LSD radix sort, a counting sort on each byte of the numbers from the lowest up.
+    # Never compares items, so takes O(n * passes), where the passes depend on how
+    # far apart the smallest and largest numbers are rather than on how many there are
+    if len(arr) <= 1:
+        return
+
+    # Sorting by the distance from the smallest number means negative numbers work too
+    minimum = min(arr)
+    span = max(arr) - minimum
+    mask = (1 << RADIX_BITS) - 1
+
+    # A copy of arr rather than a new list, so the benchmark counts writes into it like the buffer in `merge_runs`.
+    # Every item is overwritten before it is read.
+    buffer = arr.copy()
+    source, dest = arr, buffer
+    shift = 0
+
+    while span >> shift:
+        counts = [0] * (mask + 1)
+        for item in source:
+            counts[((item - minimum) >> shift) & mask] += 1
+
+        # Every number has the same digit here, so this pass would not move anything
+        if len(arr) in counts:
+            shift += RADIX_BITS
+            continue
+
+        # Turn the counts into the index each digit's numbers start at
+        total = 0
+        for digit, count in enumerate(counts):
+            counts[digit] = total
+            total += count
+
+        # Items with the same digit keep their order, so earlier passes are not undone
+        for item in source:
+            digit = ((item - minimum) >> shift) & mask
+            dest[counts[digit]] = item
+            counts[digit] += 1
+
+        source, dest = dest, source
+        shift += RADIX_BITS
+
+    if source is not arr:
+        arr[:] = source
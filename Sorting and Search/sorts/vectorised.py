@@ -0,0 +1,17 @@
+from numpy_backend import Numbers, as_array
+
+def numpy_sort(arr: Numbers, kind: str = "quicksort"):
+    # `kind` is passed on to NumPy, which has "quicksort" (an introsort), "stable"
+    # (radix sort for small ints, Timsort otherwise) and "heapsort"
+    values = as_array(arr)
+
+    # Ints too big for NumPy end up as Python objects, which would be no faster
+    if values.dtype == object:
+        arr.sort()
+        return
+
+    values.sort(kind=kind)
+
+    # Lists are the only input sorted as a copy, so the result has to be written back
+    if isinstance(arr, list):
+        arr[:] = values.tolist()